@@ -1,7 +1,9 @@
 """ The default configuration, from which all others should be derived """
 
-import os, sandbox, console, rundependent, comparetest, batch, performance, subprocess, operator, logging
+import os, sandbox, console, rundependent, comparetest, batch, performance, subprocess, operator, logging, tempfile
 from .. import plugins
+from ..utils import getUserName
+from remotecopy import RemoteCopyManager
 from copy import copy
 from string import Template
 from fnmatch import fnmatch
@@ -84,6 +86,7 @@ class Config:
                 group.addOption("xr", "Configure self-diagnostics from", os.path.join(defaultDiagDir, "logging.debug"),
                                 possibleValues=[ os.path.join(plugins.installationDir("log"), "logging.debug") ])
                 group.addOption("xw", "Write self-diagnostics to", defaultDiagDir)
+                group.addOption("xs", "Write startup timing report to", os.path.join(defaultDiagDir, "startup_profile.json"))
             elif group.name.startswith("Invisible"):
                 # Options that don't make sense with the GUI should be invisible there...
                 group.addOption("a", "Load test applications named")
@@ -412,6 +415,14 @@ class Config:
     def getTestRunVariables(self):
         return []
 
+    def testFilesPending(self, test):
+        # Whether files are still on their way from another machine
+        return False
+
+    def waitForTestFiles(self, test):
+        # Wait for files still on their way from another machine. Returns whether there were any
+        return False
+
     def noFileAdvice(self):
         # What can we suggest if files aren't present? In this case, not much
         return ""
@@ -841,6 +852,9 @@ class Config:
     def showExecHostsInFailures(self, app):
         return self.batchMode() or app.getRunMachine() != "localhost"
 
+    def recordsTestTree(self, app):
+        return False # i.e. whether other processes will need what we read of the test tree
+
     def getTestComparator(self):
         return comparetest.MakeComparisons(enableColor=self.optionMap.has_key("zen"))
 
@@ -1446,9 +1460,14 @@ class Config:
         else:
             return machine + ":" + plugins.quote(fileName)
 
-    def copyFileRemotely(self, *args, **kw):
-        proc = self.getRemoteCopyFileProcess(*args, **kw)
-        return proc.wait()
+    def copyFileRemotely(self, app, srcFile, srcMachine, dstFile, dstMachine, ignoreLinks=False):
+        return RemoteCopyManager.getInstance().copy(app, srcFile, srcMachine, dstFile, dstMachine, ignoreLinks)
+
+    def copyFilesRemotely(self, app, copyArgs):
+        return RemoteCopyManager.getInstance().copyAll(app, copyArgs)
+
+    def copyDataToMachine(self, app, localPath, machine, remoteDir):
+        return RemoteCopyManager.getInstance().copyDataToMachine(app, localPath, machine, remoteDir)
 
     def getRemoteCopyFileProcess(self, app, srcFile, srcMachine, dstFile, dstMachine, ignoreLinks=False):
         srcPath = self.getRemotePath(srcFile, srcMachine)
@@ -1468,7 +1487,27 @@ class Config:
         progStr = app.getConfigValue(setting)
         progArgs = plugins.splitcmd(progStr)
         argStr = app.getCompositeConfigValue("remote_program_options", progArgs[0])
-        return progArgs + plugins.splitcmd(argStr)
+        args = progArgs + plugins.splitcmd(argStr)
+        persistTime = app.getConfigValue("remote_connection_persist")
+        if persistTime > 0:
+            self.addConnectionSharingArgs(args, persistTime)
+        return args
+
+    def addConnectionSharingArgs(self, args, persistTime):
+        # One connection per machine, kept open for all ssh-based programs to use, rather than a new one per command
+        controlDir = os.path.join(tempfile.gettempdir(), "texttest_ssh_" + (getUserName() or "user"))
+        if not os.path.isdir(controlDir):
+            plugins.ensureDirectoryExists(controlDir)
+            os.chmod(controlDir, 0700)
+        sshOptions = [ "-o", "ControlMaster=auto", "-o", "ControlPath=" + os.path.join(controlDir, "%r@%h:%p"),
+                       "-o", "ControlPersist=" + str(persistTime) ]
+        if args[0] in [ "ssh", "scp" ]:
+            args[1:1] = sshOptions
+        elif "-e" in args[:-1]:
+            # e.g. rsync, which runs the remote shell command it is given
+            index = args.index("-e") + 1
+            if args[index].startswith("ssh"):
+                args[index] += " " + " ".join(sshOptions)
 
     def setMiscDefaults(self, app, namingScheme):
         app.setConfigDefault("default_texttest_tmp", "$TEXTTEST_PERSONAL_CONFIG/tmp", "Default value for $TEXTTEST_TMP, if it is not set")
@@ -1478,6 +1517,8 @@ class Config:
         app.setConfigDefault("remote_shell_program", "ssh", "Program to use for running commands remotely")
         app.setConfigDefault("remote_program_options", self.getDefaultRemoteProgramOptions(), "Default options to use for particular remote shell programs")
         app.setConfigDefault("remote_copy_program", "", "(UNIX) Program to use for copying files remotely, in case of non-shared file systems")
+        app.setConfigDefault("remote_copy_max_parallel", 1, "Maximum number of remote copies to run at the same time")
+        app.setConfigDefault("remote_connection_persist", 0, "(UNIX) Seconds to keep ssh connections to remote machines open for reuse by later commands and copies. 0 means don't share connections")
         app.setConfigDefault("default_filter_file", [], "Filter file to use by default, generally only useful for versions")
         app.setConfigDefault("test_data_environment", {}, "Environment variables to be redirected for linked/copied test data")
         app.setConfigDefault("test_data_require", [], "Test data names that are required to exist for the SUT to work")
@@ -1,6 +1,6 @@
 #!/usr/local/bin/python
 
-import os, sys, time, shutil, datetime, testoverview, logging, re, tarfile, stat
+import os, sys, time, shutil, datetime, logging, re, tarfile, stat
 from texttestlib import plugins
 from summarypages import GenerateSummaryPage, GenerateGraphs # only so they become package level entities
 from ordereddict import OrderedDict
@@ -539,6 +539,7 @@ class MigrateBatchRepository(plugins.Action):
         self.successFileName = "succeeded_runs"
 
     def migrateFile(self, path):
+        import testoverview
         state = testoverview.GenerateWebPages.readState(path)
         if state.hasSucceeded():
             dirname, fn = os.path.split(path)
@@ -1048,6 +1049,8 @@ class WebPageResponder(plugins.Responder):
             plugins.printException()
 
     def getWebPageGenerator(self, getConfigValue, *args):
+        # HTML generation is a lot of code, only import it when there are pages to generate
+        import testoverview
         return testoverview.GenerateWebPages(getConfigValue, *args)
 
     def generateWebPages(self, subDirs, getConfigValue, *args):
@@ -1,6 +1,6 @@
 """ Code related to building the summary page and the graphs etc. """
 
-import testoverview, logging, os, shutil, time, operator, sys
+import logging, os, shutil, time, operator, sys
 from texttestlib import plugins
 from HTMLParser import HTMLParser
 from ordereddict import OrderedDict
@@ -104,6 +104,7 @@ class SummaryDataFinder:
         self.appRuns = {}
         self.colourFinder, self.inputOptions = None, None
         if len(apps) > 0:
+            import testoverview
             self.colourFinder = testoverview.ColourFinder(apps[0][0].getCompositeConfigValue)
             self.inputOptions = apps[0][0].inputOptions
         appnames = set()
@@ -407,6 +408,7 @@ class SummaryGenerator:
             return "test run" + suffix + " " + ", ".join(mostRecentTags)
 
     def generatePage(self, dataFinder, appsWithVersions, fileToUrl):
+        import testoverview
         jobLink = ""
         creationDate = testoverview.TitleWithDateStamp("").__str__().strip()
         if os.getenv("JENKINS_URL") and os.getenv("JOB_NAME") and os.getenv("BUILD_NUMBER"):
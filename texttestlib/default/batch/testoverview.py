@@ -1,7 +1,7 @@
 # Code to generate HTML report of historical information. This report generated
 # either via the -coll flag, or via -s 'batch.GenerateHistoricalReport <batchid>'
 
-import os, time, HTMLgen, HTMLcolors, cgi, sys, logging, jenkinschanges, locale
+import os, time, HTMLgen, HTMLcolors, cgi, sys, logging, locale
 from texttestlib import plugins
 from cPickle import Unpickler, UnpicklingError
 from ordereddict import OrderedDict
@@ -551,6 +551,7 @@ class TestTable:
             fileFinder = self.getConfigValue("batch_jenkins_archive_file_pattern")
             prevBuildNumber = self.getJenkinsBuildNumber(prevTag) if prevTag else None
             if buildNumber.isdigit() and prevBuildNumber is not None:
+                import jenkinschanges
                 try:
                     allChanges = jenkinschanges.getChanges(prevBuildNumber, buildNumber, bugSystemData, markedArtefacts, fileFinder, cacheDir)
                     plugins.ensureDirectoryExists(cacheDir)
@@ -783,6 +784,7 @@ class TestTable:
             if jenkinsUrl and buildNumber.isdigit():
                 runEnv = getEnvironmentFromRunFiles(runNameDirs, tag)
                 container = HTMLgen.Container()
+                import jenkinschanges
                 tooltip = jenkinschanges.getTimestamp(buildNumber)
                 container.append(HTMLgen.Href(linkTarget, linkText, title=tooltip))
                 container.append(HTMLgen.BR())
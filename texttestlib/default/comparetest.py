@@ -392,6 +392,8 @@ class TestComparison(BaseTestComparison):
         elif any(("/" in stem for stem in onlyStems)): # We've explicitly selected split files
             self.rebuildFromSplit(onlyStems, test, exact, versionString, backupVersions)
         if overwriteSuccessFiles:
+            # Files that were the same might still be on their way from where the test ran
+            test.app.waitForTestFiles(test)
             for comparison in self.filterComparisons(self.correctResults, onlyStems):
                 self.updateStatus(test, str(comparison), versionString)
                 comparison.overwrite(test, exact, versionString, backupVersions)
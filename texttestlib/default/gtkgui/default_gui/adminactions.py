@@ -163,37 +163,42 @@ class PasteTests(FocusDependentAction):
             raise plugins.TextTestError, "Cannot paste test there, as the copied test and currently selected test have no application/version in common"
 
         suiteDeltas = {} # When we insert as we go along, need to update subsequent placements
-        for test, (suite, placement, newName) in destInfo.items():
-            suiteDeltas.setdefault(suite, 0)
-            realPlacement = placement + suiteDeltas.get(suite)
-            if self.removeAfter and newName == test.name and suite is test.parent:
-                # Cut + paste to the same suite is basically a reposition, do it as one action
-                repositionPlacement = self.getRepositionPlacement(test, realPlacement)
-                plugins.tryFileChange(test.parent.repositionTest, "Failed to reposition test: no permissions to edit the testsuite file",
-                                      test, repositionPlacement)
-                newTests.append(test)
-            else:
-                newDesc = self.getNewDescription(test)
-                # Create test files first, so that if it fails due to e.g. full disk, we won't register the test either...
-                testDir = suite.getNewDirectoryName(newName)
-                try:
-                    self.moveOrCopy(test, testDir)
-                    suite.registerTest(newName, newDesc, realPlacement)
-                    testImported = suite.addTest(test.__class__, os.path.basename(testDir), newDesc, realPlacement)
-                    # "testImported" might in fact be a suite: in which case we should read all the new subtests which
-                    # might have also been copied
-                    testImported.readContents(initial=False)
-                    testImported.updateAllRelPaths(test.getRelPath())
-                    suiteDeltas[suite] += 1
-                    newTests.append(testImported)
-                    if self.removeAfter:
-                        message = "Failed to remove old test: didn't have sufficient write permission to the test files. Test copied instead of moved."
-                        plugins.tryFileChange(test.remove, message)
-                except EnvironmentError, e:
-                    if os.path.isdir(testDir):
-                        shutil.rmtree(testDir)
-                    self.showErrorDialog("Failed to paste test:\n" + str(e))
-                    
+        pastedTests = []
+        # Write each testsuite file once, not once per test
+        fileHandler = testmodel.TestSuite.testSuiteFileHandler
+        fileHandler.startBatch()
+        try:
+            for test, (suite, placement, newName) in destInfo.items():
+                suiteDeltas.setdefault(suite, 0)
+                realPlacement = placement + suiteDeltas.get(suite)
+                if self.removeAfter and newName == test.name and suite is test.parent:
+                    # Cut + paste to the same suite is basically a reposition, do it as one action
+                    repositionPlacement = self.getRepositionPlacement(test, realPlacement)
+                    plugins.tryFileChange(test.parent.repositionTest, "Failed to reposition test: no permissions to edit the testsuite file",
+                                          test, repositionPlacement)
+                    newTests.append(test)
+                else:
+                    newDesc = self.getNewDescription(test)
+                    # Create test files first, so that if it fails due to e.g. full disk, we won't register the test either...
+                    testDir = suite.getNewDirectoryName(newName)
+                    try:
+                        self.moveOrCopy(test, testDir)
+                        suite.registerTest(newName, newDesc, realPlacement)
+                        testImported = suite.addTest(test.__class__, os.path.basename(testDir), newDesc, realPlacement)
+                        # "testImported" might in fact be a suite: in which case we should read all the new subtests which
+                        # might have also been copied
+                        testImported.readContents(initial=False)
+                        testImported.updateAllRelPaths(test.getRelPath())
+                        suiteDeltas[suite] += 1
+                        newTests.append(testImported)
+                        pastedTests.append((test, testImported, testDir))
+                    except EnvironmentError, e:
+                        self.undoMoveOrCopy(test, testDir)
+                        self.showErrorDialog("Failed to paste test:\n" + str(e))
+        finally:
+            # Whatever happened, what's on disk and in memory should agree with the testsuite files
+            self.finishPaste(fileHandler.flushBatch(), pastedTests, newTests, suiteDeltas)
+
         self.notify("SetTestSelection", newTests)
         self.currTestSelection = newTests
         self.notify("Status", self.getStatusMessage(suiteDeltas))
@@ -215,6 +220,41 @@ class PasteTests(FocusDependentAction):
     def getSignalsSent(self):
         return [ "SetTestSelection", "Clipboard" ]
 
+    def finishPaste(self, failures, pastedTests, newTests, suiteDeltas):
+        if failures:
+            # The tests are on disk but their suites don't list them, so take them away again
+            for test, testImported, testDir in pastedTests:
+                suite = testImported.parent
+                if suite.getContentFileName() in failures:
+                    testImported.removeFromMemory()
+                    self.undoMoveOrCopy(test, testDir)
+                    suiteDeltas[suite] -= 1
+                    newTests.remove(testImported)
+            self.showErrorDialog("Failed to paste test:\n" + "\n".join(failures.values()))
+
+        if self.removeAfter:
+            # Only now their new location is written down
+            self.removeOriginals([ test for test, testImported, _ in pastedTests if testImported in newTests ])
+
+    def removeOriginals(self, tests):
+        fileHandler = testmodel.TestSuite.testSuiteFileHandler
+        fileHandler.startBatch()
+        try:
+            for test in tests:
+                message = "Failed to remove old test: didn't have sufficient write permission to the test files. Test copied instead of moved."
+                plugins.tryFileChange(test.remove, message)
+        finally:
+            failures = fileHandler.flushBatch()
+        if failures:
+            self.showErrorDialog("Failed to remove old test from its test suite:\n" + "\n".join(failures.values()))
+
+    def undoMoveOrCopy(self, test, newDirName):
+        if os.path.isdir(newDirName):
+            if self.removeAfter:
+                self.movePath(newDirName, test.getDirectory())
+            else:
+                shutil.rmtree(newDirName)
+
     def moveOrCopy(self, test, newDirName):
         # If it exists it's because a previous copy has already taken across the directory
         if not os.path.isdir(newDirName):
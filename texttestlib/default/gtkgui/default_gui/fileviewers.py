@@ -80,6 +80,9 @@ class FileViewAction(guiplugins.ActionGUI):
                       os.path.basename(fileToView).split(".")[0] + \
                       "'.\nPlease point the configuration entry '" + self.getToolConfigEntry() + \
                       "' at a valid program to view the file."
+        elif self.testFilesPending():
+            raise plugins.TextTestError, "File '" + os.path.basename(fileName) + \
+                      "' cannot be viewed yet, it is still being fetched from the machine where the test ran."
         else:
             raise plugins.TextTestError, "File '" + os.path.basename(fileName) + \
                       "' cannot be viewed as it has been removed in the file system." + self.noFileAdvice()
@@ -104,6 +107,13 @@ class FileViewAction(guiplugins.ActionGUI):
         except AttributeError:
             return fileName
         
+    def testFilesPending(self):
+        if len(self.currTestSelection) > 0:
+            test = self.currTestSelection[0]
+            return test.app.testFilesPending(test)
+        else:
+            return False
+
     def noFileAdvice(self):
         if len(self.currAppSelection) > 0:
             return "\n" + self.currAppSelection[0].noFileAdvice()
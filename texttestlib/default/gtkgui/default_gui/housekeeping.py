@@ -6,7 +6,8 @@ Miscellaneous actions for generally housekeeping the state of the GUI
 from .. import guiplugins
 from ordereddict import OrderedDict
 from texttestlib.default.batch import BatchApplicationData, MailSender
-from texttestlib import plugins
+from texttestlib import plugins, testmodel
+from copy import deepcopy
 import os, gtk, gobject
 from texttestlib.jobprocess import killSubProcessAndChildren
 
@@ -109,6 +110,7 @@ class RefreshAll(guiplugins.BasicActionGUI):
     def __init__(self, *args):
         guiplugins.BasicActionGUI.__init__(self, *args)
         self.rootTestSuites = []
+        self.watcher = testmodel.makeTestTreeWatcher()
     def _getTitle(self):
         return "Refresh"
     def _getStockId(self):
@@ -121,17 +123,24 @@ class RefreshAll(guiplugins.BasicActionGUI):
         return "Refreshed the test suite from the files"
     def addSuites(self, suites):
         self.rootTestSuites += suites
+        self.watcher.findChangedDirectories(self.rootTestSuites)
     def notifyRefresh(self):
         # when done indirectly
         self.performOnCurrent()
     def performOnCurrent(self):
+        # Only look at the parts of the tree where files have changed, unless we can't tell
+        changedDirs = self.watcher.findChangedDirectories(self.rootTestSuites)
         for suite in self.rootTestSuites:
             self.notify("ActionProgress")
+            oldConfigDir = deepcopy(suite.app.configDir)
             suite.app.setUpConfiguration()
             self.notify("ActionProgress")
             filters = suite.app.getFilterList(self.rootTestSuites)
-            suite.refresh(filters)
-            suite.refreshFilesRecursively()
+            if changedDirs is None or suite.app.configDir != oldConfigDir:
+                suite.refresh(filters)
+                suite.refreshFilesRecursively()
+            else:
+                suite.refreshChanged(filters, changedDirs)
     
 class ViewScreenshots(guiplugins.ActionGUI):
     def _getTitle(self):
@@ -0,0 +1,199 @@
+"""
+Copying files to and from other machines with the configured remote_copy_program.
+All copies made by the process share a limited number of slots, so several can be running at once,
+possibly from different threads, without swamping the network or the machines at the other end.
+"""
+
+import os, time, logging, hashlib
+from threading import Lock, Event, Thread, BoundedSemaphore
+from ordereddict import OrderedDict
+from texttestlib import plugins
+
+class MachineStatistics:
+    def __init__(self):
+        self.copies = 0
+        self.failures = 0
+        self.deduplicated = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def describe(self, machine):
+        megabytes = self.bytes / 1024.0 / 1024.0
+        text = machine + " : " + str(self.copies) + " copies, %.1f MB in %.1f seconds" % (megabytes, self.seconds)
+        if self.seconds > 0:
+            text += " (%.2f MB/s)" % (megabytes / self.seconds)
+        if self.deduplicated:
+            text += ", " + str(self.deduplicated) + " copied from identical data already there"
+        if self.failures:
+            text += ", " + str(self.failures) + " failed"
+        return text
+
+
+class CopiedData:
+    def __init__(self, remotePath):
+        self.remotePath = remotePath
+        self.succeeded = False
+        self.done = Event()
+
+
+class RemoteCopyManager:
+    instance = None
+    @classmethod
+    def getInstance(cls):
+        if cls.instance is None:
+            cls.instance = cls()
+        return cls.instance
+
+    def __init__(self):
+        self.diag = logging.getLogger("Remote Copy")
+        self.lock = Lock()
+        self.slots = None
+        self.statistics = OrderedDict()
+        # Data sent to each machine, by content, so identical data can be copied there from where it already is
+        self.copiedData = {}
+        self.contentHashes = {}
+
+    def getSlots(self, app):
+        with self.lock:
+            if self.slots is None:
+                slotCount = max(1, app.getConfigValue("remote_copy_max_parallel"))
+                self.diag.info("Allowing " + str(slotCount) + " remote copies at once")
+                self.slots = BoundedSemaphore(slotCount)
+            return self.slots
+
+    def getStatistics(self, machine):
+        with self.lock:
+            return self.statistics.setdefault(machine, MachineStatistics())
+
+    def copy(self, app, srcFile, srcMachine, dstFile, dstMachine, ignoreLinks=False):
+        machine = srcMachine if srcMachine != "localhost" else dstMachine
+        with self.getSlots(app):
+            self.diag.info("Copying " + srcFile + " on " + srcMachine + " to " + dstFile + " on " + dstMachine)
+            startTime = time.time()
+            proc = app.configObject.getRemoteCopyFileProcess(app, srcFile, srcMachine, dstFile, dstMachine, ignoreLinks)
+            exitCode = proc.wait()
+            seconds = time.time() - startTime
+        # Size what's on this machine: what we sent, or where we received it
+        localPath = srcFile if srcMachine == "localhost" else dstFile
+        copiedBytes = self.getSize(localPath) if exitCode == 0 else 0
+        stats = self.getStatistics(machine)
+        with self.lock:
+            stats.copies += 1
+            stats.seconds += seconds
+            stats.bytes += copiedBytes
+            if exitCode:
+                stats.failures += 1
+        self.diag.info("Copied " + str(copiedBytes) + " bytes in " + str(round(seconds, 3)) + " seconds, exit code " + str(exitCode))
+        return exitCode
+
+    def copyAll(self, app, copyArgs):
+        # Returns the exit codes in the same order, the slots decide how many actually run at once
+        return self.callInThreads([ plugins.Callable(self.copy, app, *args) for args in copyArgs ])
+
+    def copyDataToMachine(self, app, localPath, machine, remoteDir):
+        # For data that is often the same for many tests, e.g. in a shared directory copied into each sandbox.
+        # It is sent once to a store on the machine, which tests don't touch, and each sandbox gets a copy from there
+        remotePath = os.path.join(remoteDir, os.path.basename(localPath))
+        contentHash = self.getContentHash(localPath)
+        storeDir = os.path.join(self.getDataStoreDir(app, remoteDir), contentHash)
+        key = machine, contentHash
+        with self.lock:
+            copiedData = self.copiedData.get(key)
+            sendData = copiedData is None
+            if sendData:
+                copiedData = self.copiedData[key] = CopiedData(os.path.join(storeDir, os.path.basename(localPath)))
+
+        if sendData:
+            copiedData.succeeded = self.sendToStore(app, localPath, machine, storeDir)
+            if not copiedData.succeeded:
+                with self.lock:
+                    del self.copiedData[key] # let the next one try again
+            copiedData.done.set()
+        else:
+            copiedData.done.wait()
+        if copiedData.succeeded:
+            self.diag.info("Copying " + localPath + " from stored data at " + copiedData.remotePath + " on " + machine)
+            cmdArgs = [ "cp", "-Rp", plugins.quote(copiedData.remotePath), plugins.quote(remotePath) ]
+            if app.runCommandOn(machine, cmdArgs, collectExitCode=True) == 0:
+                if not sendData:
+                    stats = self.getStatistics(machine)
+                    with self.lock:
+                        stats.deduplicated += 1
+                return 0
+        # It may have been removed since, just send it directly
+        return self.copy(app, localPath, "localhost", remoteDir, machine)
+
+    @staticmethod
+    def getDataStoreDir(app, remoteDir):
+        appTmpDir = app.getRemoteTmpDirectory()[1]
+        return os.path.join(appTmpDir or os.path.dirname(remoteDir), ".texttest_data")
+
+    def sendToStore(self, app, localPath, machine, storeDir):
+        try:
+            app.ensureRemoteDirExists(machine, storeDir)
+        except plugins.TextTestError, e:
+            self.diag.info("Failed to create " + storeDir + " on " + machine + " : " + str(e))
+            return False
+        return self.copy(app, localPath, "localhost", storeDir, machine) == 0
+
+    @staticmethod
+    def callInThreads(methods):
+        results = [ None ] * len(methods)
+        def call(i, method):
+            results[i] = method()
+        threads = [ Thread(target=call, args=(i, method)) for i, method in enumerate(methods) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def getContentHash(self, path):
+        # Changing a file in a subdirectory doesn't change the top directory's modification time or size, so check them all
+        files = self.findFiles(path)
+        fileStats = []
+        for filePath, relPath in files:
+            statObj = os.stat(filePath)
+            fileStats.append((relPath, statObj.st_mtime, statObj.st_size))
+        cacheKey = os.path.realpath(path), tuple(fileStats)
+        with self.lock:
+            if cacheKey in self.contentHashes:
+                return self.contentHashes[cacheKey]
+        contentHash = hashlib.sha1()
+        for filePath, relPath in files:
+            contentHash.update(relPath + "\0")
+            with open(filePath, "rb") as f:
+                for block in iter(lambda: f.read(65536), ""):
+                    contentHash.update(block)
+        digest = contentHash.hexdigest()
+        with self.lock:
+            self.contentHashes[cacheKey] = digest
+        return digest
+
+    @staticmethod
+    def findFiles(path):
+        # Relative to the path, which will have a different name when copied
+        if not os.path.isdir(path):
+            return [ (path, "") ]
+        files = []
+        for root, dirs, fileNames in os.walk(path, followlinks=True):
+            dirs.sort()
+            for fileName in sorted(fileNames):
+                filePath = os.path.join(root, fileName)
+                if os.path.isfile(filePath):
+                    files.append((filePath, os.path.relpath(filePath, path)))
+        return files
+
+    def getSize(self, path):
+        try:
+            return sum((os.path.getsize(filePath) for filePath, _ in self.findFiles(path)))
+        except OSError:
+            return 0 # e.g. a glob pattern for the source, or partly removed
+
+    def getStatisticsLines(self):
+        with self.lock:
+            return [ stats.describe(machine) for machine, stats in self.statistics.items() ]
+
+    def logStatistics(self, log=None):
+        for line in self.getStatisticsLines():
+            (log or self.diag).info(line)
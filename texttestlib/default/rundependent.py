@@ -1,11 +1,12 @@
 #!/usr/bin/env python2
 
 
-import os
-import fpdiff, logging, shutil
+import os, sys, re
+import fpdiff, logging, shutil, tempfile
 from texttestlib import plugins
 from optparse import OptionParser
 from StringIO import StringIO
+from collections import deque
 
 class Filtering(plugins.TestState):
     def __init__(self, name, **kw):
@@ -13,6 +14,7 @@ class Filtering(plugins.TestState):
         
 # Generic base class for filtering standard and temporary files
 class FilterAction(plugins.Action):
+    maxBufferSize = 64 * 1024 * 1024
     def __init__(self, useFilteringStates=False):
         self.diag = logging.getLogger("Filter Actions")
         self.useFilteringStates = useFilteringStates
@@ -33,8 +35,32 @@ class FilterAction(plugins.Action):
         pass
 
     def performAllFilterings(self, test, stem, fileName, newFileName):
-        currFileName = fileName
         filters = self.makeAllFilters(test, stem, test.app)
+        if len(filters) == 0:
+            return
+        if self.diag.isEnabledFor(logging.INFO):
+            # Keep what each filter produced, to see which one did what
+            self.performFilteringsViaFiles(filters, fileName, newFileName)
+        else:
+            self.performFilteringsViaBuffers(filters, fileName, newFileName)
+
+    def performFilteringsViaBuffers(self, filters, fileName, newFileName):
+        # Only the final result is written out. Filters may reread their input and go back over their output,
+        # so pass it between them in buffers, which only use the disk for very large files
+        currFile = open(fileName, "rU") # use universal newlines to simplify
+        for fileFilter in filters[:-1]:
+            buffer = tempfile.SpooledTemporaryFile(max_size=self.maxBufferSize)
+            fileFilter.filterFile(currFile, buffer)
+            currFile.close()
+            currFile = buffer
+            currFile.seek(0)
+        writeFile = plugins.openForWrite(newFileName)
+        filters[-1].filterFile(currFile, writeFile)
+        writeFile.close()
+        currFile.close()
+
+    def performFilteringsViaFiles(self, filters, fileName, newFileName):
+        currFileName = fileName
         for fileFilter in filters:
             writeFileName = newFileName + "." + fileFilter.postfix
             self.diag.info("Applying " + fileFilter.__class__.__name__ + " to make\n" + writeFileName + " from\n " + currFileName) 
@@ -46,8 +72,7 @@ class FilterAction(plugins.Action):
             fileFilter.filterFile(currFile, writeFile)
             writeFile.close()
             currFileName = writeFileName
-        if len(filters) > 0 and currFileName != newFileName:
-            shutil.move(currFileName, newFileName)
+        shutil.move(currFileName, newFileName)
 
     def getAllFilters(self, test, fileName, app):
         stem = self.getStem(fileName)
@@ -208,26 +233,23 @@ class RunDependentTextFilter(plugins.Observable):
                 if lineFilter in relevantFilters:
                     orderedRelevantFilters.append((lineFilter, None))
                 else:
-                    lastLine = self.getLastLine(relevantSectionFilters, lineFilter)
+                    lastLine = relevantSectionFilters.get(lineFilter)
                     if lastLine:
                         orderedRelevantFilters.append((lineFilter, lastLine))
             return orderedRelevantFilters
         else:
             return [ (f, None) for f in relevantFilters ]
 
-    def getLastLine(self, filters, lineFilter):
-        for f, lastLine in reversed(filters):
-            if f is lineFilter:
-                return lastLine
-
     def findRelevantSectionFilters(self, sectionFilters, file):
+        # Returns the last line where each section filter's end was found after its start.
+        # Keep just the latest, a growing list of them made this quadratic in the file length
         lineNumber = 0
-        matchedFirst, relevantFilters = [], []
+        matchedFirst, relevantFilters = [], {}
         for line in file:
             lineNumber += 1
             for sectionFilter in matchedFirst:
-                if sectionFilter not in relevantFilters and sectionFilter.untrigger.matches(line, lineNumber):
-                    relevantFilters.append((sectionFilter, lineNumber))
+                if sectionFilter.untrigger.matches(line, lineNumber):
+                    relevantFilters[sectionFilter] = lineNumber
             for sectionFilter in sectionFilters:
                 if sectionFilter not in matchedFirst and \
                     sectionFilter.trigger.matches(line, lineNumber) and not sectionFilter.untrigger.matches(line, lineNumber):
@@ -240,25 +262,44 @@ class RunDependentTextFilter(plugins.Observable):
 
     def filterFile(self, file, newFile, filteredAway=None):
         lineNumber = 0
-        seekPoints = []
         lineFilters = self.findRelevantFilters(file)
+        # Output from the most recent lines is held back, as far as any filter can remove lines before the one it matches
+        lookBack = max([ lineFilter.prevLinesToRemove for lineFilter, _ in lineFilters ] + [ 0 ])
+        recentLines = deque()
+        triggerMatcher = CombinedTriggerMatcher([ lineFilter.trigger for lineFilter, _ in lineFilters ])
+        checkAllFrom = self.getLineToCheckAllFrom(lineFilters, lineNumber)
         for line in file:
             # We don't want to stack up ActionProgreess calls in ThreaderNotificationHandler ...
             self.notifyIfMainThread("ActionProgress")
             lineNumber += 1
-            lineFilter, filteredLine, removeCount = self.getFilteredLine(line, lineNumber, lineFilters)
+            if lineNumber < checkAllFrom and not triggerMatcher.mightMatch(line, lineNumber):
+                # No filter can change this line, or its own state by looking at it
+                lineFilter, filteredLine, removeCount = None, line, 0
+            else:
+                lineFilter, filteredLine, removeCount = self.getFilteredLine(line, lineNumber, lineFilters)
+                checkAllFrom = self.getLineToCheckAllFrom(lineFilters, lineNumber)
             if removeCount:
-                seekPoint = seekPoints[-removeCount - 1]
                 self.diag.info("Removing " + repr(removeCount) + " lines")
-                newFile.seek(seekPoint)
-                newFile.truncate()
-                seekPoints = []
-            if filteredLine:
-                newFile.write(filteredLine)
-            else:
-                if filteredAway is not None and lineFilter is not None:
-                    filteredAway.setdefault(lineFilter, []).append(line)
-            seekPoints.append(newFile.tell())
+                for _ in range(min(removeCount, len(recentLines))):
+                    recentLines.pop()
+            if not filteredLine and filteredAway is not None and lineFilter is not None:
+                filteredAway.setdefault(lineFilter, []).append(line)
+            recentLines.append(filteredLine)
+            if len(recentLines) > lookBack:
+                self.writeLine(newFile, recentLines.popleft())
+        for filteredLine in recentLines:
+            self.writeLine(newFile, filteredLine)
+
+    def writeLine(self, newFile, filteredLine):
+        if filteredLine:
+            newFile.write(filteredLine)
+
+    def getLineToCheckAllFrom(self, lineFilters, lineNumber):
+        # Filters removing following lines, or sections ending, need to see every line
+        if any((lineFilter.autoRemove for lineFilter, _ in lineFilters)):
+            return lineNumber + 1
+        lastLines = [ lastLine for _, lastLine in lineFilters if lastLine is not None ]
+        return min(lastLines) if lastLines else sys.maxint
 
     def getFilteredLine(self, line, lineNumber, lineFilters):
         appliedLineFilter = None
@@ -306,6 +347,49 @@ class UnorderedTextFilter(RunDependentTextFilter):
             newFile.write("\n")
   
 
+class CombinedTriggerMatcher:
+    # Finds out whether any of the triggers might match a line, with a single regular expression search
+    # for as many of them as possible. Usually most lines match nothing, and can then be left as they are
+    # without asking each filter in turn
+    uncombinableSyntax = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[iLmsux]")
+    def __init__(self, triggers):
+        self.lineNumbers = set()
+        self.separateRegexes = []
+        self.alwaysMatches = False
+        patterns = []
+        for trigger in triggers:
+            if isinstance(trigger, LineNumberTrigger):
+                self.lineNumbers.add(trigger.lineNumber)
+            elif not isinstance(trigger, plugins.TextTrigger):
+                self.alwaysMatches = True
+            elif trigger.regex is not None:
+                # Group numbers, group names and flags would mean something else when combined
+                if self.uncombinableSyntax.search(trigger.text):
+                    self.separateRegexes.append(trigger.regex)
+                else:
+                    patterns.append(trigger.text)
+            elif trigger.matchEmptyString:
+                patterns.append(re.escape(trigger.text))
+            else:
+                self.alwaysMatches = True
+        self.combinedRegex = self.combine(patterns)
+
+    def combine(self, patterns):
+        if patterns:
+            try:
+                return re.compile("|".join(("(?:" + pattern + ")" for pattern in patterns)))
+            except (re.error, AssertionError, OverflowError):
+                # e.g. too many groups between them
+                self.separateRegexes += [ re.compile(pattern) for pattern in patterns ]
+
+    def mightMatch(self, line, lineNumber):
+        if self.alwaysMatches or lineNumber in self.lineNumbers:
+            return True
+        if self.combinedRegex is not None and self.combinedRegex.search(line):
+            return True
+        return any((regex.search(line) for regex in self.separateRegexes))
+
+
 class LineNumberTrigger:
     def __init__(self, lineNumber):
         self.lineNumber = lineNumber
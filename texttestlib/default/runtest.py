@@ -37,11 +37,19 @@ class RunTest(plugins.Action):
     def __init__(self):
         self.diag = logging.getLogger("run test")
         self.killDiag = logging.getLogger("kill processes")
+        self.clearTestState()
+
+    def clearTestState(self):
         self.currentProcess = None
         self.currentTimer = None
         self.killedTests = []
         self.killSignal = None
         self.lock = Lock()
+
+    def makeParallelCopy(self):
+        newAction = plugins.Action.makeParallelCopy(self)
+        newAction.clearTestState()
+        return newAction
         
     def __repr__(self):
         return "Running"
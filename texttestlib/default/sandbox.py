@@ -2,8 +2,10 @@ import os, shutil, re, stat, subprocess, glob, logging, difflib, time,sys
 from texttestlib import plugins
 from texttestlib.jobprocess import killArbitaryProcess, killSubProcessAndChildren
 from runtest import Killed
+from remotecopy import RemoteCopyManager
 from ordereddict import OrderedDict
 from string import Template
+from threading import Lock
 
 
 def getScriptArgs(script):
@@ -36,13 +38,18 @@ class PrepareWriteDirectory(plugins.Action):
         machine, remoteTmpDir = test.app.getRemoteTestTmpDir(test)
         if remoteTmpDir:
             test.app.ensureRemoteDirExists(machine, remoteTmpDir)
-            remoteCopy = plugins.Callable(self.copyDataRemotely, test, machine, remoteTmpDir)
+            # Collate everything first, so the copies can be made at the same time
+            pathsToCopy = []
+            self.collateAllPaths(test, pathsToCopy.append)
+            self.copyAllDataRemotely(pathsToCopy, test, machine, remoteTmpDir)
         else:
-            remoteCopy = None
-
-        self.collateAllPaths(test, remoteCopy)
+            self.collateAllPaths(test, None)
         test.createPropertiesFiles()
 
+    @classmethod
+    def finalise(cls):
+        RemoteCopyManager.getInstance().logStatistics()
+
     def collateAllPaths(self, test, remoteCopy):
         self.collatePaths(test, "copy_test_path", self.copyTestPath, remoteCopy)
         self.collatePaths(test, "copy_test_path_merge", self.copyTestPath, remoteCopy, mergeData=True)
@@ -108,16 +115,22 @@ class PrepareWriteDirectory(plugins.Action):
             # Don't merge, just use the most specific data
             return sourcePaths[-1:]
 
-    def copyDataRemotely(self, sourcePath, test, machine, remoteTmpDir):
-        if os.path.exists(sourcePath):
+    def copyAllDataRemotely(self, sourcePaths, test, machine, remoteTmpDir):
+        methods = []
+        for sourcePath in filter(os.path.exists, sourcePaths):
             copyScript = test.getCompositeConfigValue("copy_test_path_script", os.path.basename(sourcePath), expandVars=False)
             if copyScript:
-                scriptSource = os.path.join(remoteTmpDir, "scriptSource")
-                test.app.copyFileRemotely(sourcePath, "localhost", scriptSource, machine)
-                cmdArgs = getScriptArgs(copyScript) + [ scriptSource, os.path.join(remoteTmpDir, os.path.basename(sourcePath)) ]
-                test.app.runCommandOn(machine, cmdArgs)
+                # These all use the same remote file, so do them one at a time
+                self.copyDataRemotelyWithScript(sourcePath, copyScript, test, machine, remoteTmpDir)
             else:
-                test.app.copyFileRemotely(sourcePath, "localhost", remoteTmpDir, machine)
+                methods.append(plugins.Callable(test.app.copyDataToMachine, sourcePath, machine, remoteTmpDir))
+        RemoteCopyManager.callInThreads(methods)
+
+    def copyDataRemotelyWithScript(self, sourcePath, copyScript, test, machine, remoteTmpDir):
+        scriptSource = os.path.join(remoteTmpDir, "scriptSource")
+        test.app.copyFileRemotely(sourcePath, "localhost", scriptSource, machine)
+        cmdArgs = getScriptArgs(copyScript) + [ scriptSource, os.path.join(remoteTmpDir, os.path.basename(sourcePath)) ]
+        test.app.runCommandOn(machine, cmdArgs)
             
     def getEnvironmentSourcePath(self, configName, test):
         pathName = self.getPathFromEnvironment(configName, test)
@@ -601,10 +614,20 @@ class TestEnvironmentCreator:
 
 
 class CollateFiles(plugins.Action):
+    # The working directory is shared by all threads, and tests may be run in several at once
+    chdirLock = Lock()
     def __init__(self):
+        self.clearTestState()
+        self.diag = logging.getLogger("Collate Files")
+
+    def clearTestState(self):
         self.filesPresentBefore = {}
         self.collationProc = None
-        self.diag = logging.getLogger("Collate Files")
+
+    def makeParallelCopy(self):
+        newAction = plugins.Action.makeParallelCopy(self)
+        newAction.clearTestState()
+        return newAction
 
     def expandCollations(self, test):
         newColl = OrderedDict()
@@ -769,10 +792,13 @@ class CollateFiles(plugins.Action):
         return localTestDir, localFiles
         
     def globDir(self, testDir, sourcePattern):
-        origCwd = os.getcwd()
-        os.chdir(testDir)
-        result = glob.glob(sourcePattern)
-        os.chdir(origCwd)
+        with self.chdirLock:
+            origCwd = os.getcwd()
+            os.chdir(testDir)
+            try:
+                result = glob.glob(sourcePattern)
+            finally:
+                os.chdir(origCwd)
         return [ os.path.join(testDir, f) for f in result ]
 
     def findPaths(self, test, sourcePattern):
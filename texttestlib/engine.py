@@ -1,13 +1,102 @@
 #!/usr/bin/env python2
 
-import plugins, os, sys, testmodel, signal, operator, logging
-from threading import Thread
+import plugins, os, sys, testmodel, signal, operator, logging, __builtin__
+from threading import Thread, Lock, local, currentThread
 from ordereddict import OrderedDict
-from time import sleep
 from glob import glob
 from copy import copy
+from contextlib import contextmanager
 import time
 
+# Records where TextTest spends its time before the tests start, enabled by the -xs option.
+# Phases nest per thread. Directory listings and file reads are counted by wrapping os.listdir and open,
+# which is only done while the profiler is active
+class StartupProfiler:
+    def __init__(self):
+        self.fileName = None
+        self.records = []
+        self.counts = OrderedDict([ ("directory listings", 0), ("file reads", 0) ])
+        self.countLock = Lock()
+        self.openRecords = local()
+        self.startTimes = None
+        self.origListdir, self.origOpen = os.listdir, __builtin__.open
+
+    def isActive(self):
+        return self.fileName is not None
+
+    def start(self, fileName):
+        self.fileName = fileName
+        self.startTimes = self.getTimes()
+        os.listdir = self.countCall("directory listings", self.origListdir)
+        __builtin__.open = self.countCall("file reads", self.origOpen)
+
+    @staticmethod
+    def getTimes():
+        # CPU time is for the whole process, i.e. all threads
+        times = os.times()
+        return time.time(), times[0] + times[1]
+
+    def countCall(self, countName, method):
+        def countedMethod(*args, **kw):
+            with self.countLock:
+                self.counts[countName] += 1
+            return method(*args, **kw)
+        return countedMethod
+
+    @contextmanager
+    def phase(self, name):
+        if not self.isActive():
+            yield
+            return
+        stack = self.openRecords.__dict__.setdefault("stack", [])
+        record = OrderedDict([ ("name", name), ("wall", 0.0), ("cpu", 0.0), ("children", []) ])
+        if stack:
+            stack[-1]["children"].append(record)
+        else:
+            self.records.append(record)
+        stack.append(record)
+        wallStart, cpuStart = self.getTimes()
+        try:
+            yield
+        finally:
+            wallEnd, cpuEnd = self.getTimes()
+            record["wall"] = round(wallEnd - wallStart, 6)
+            record["cpu"] = round(cpuEnd - cpuStart, 6)
+            stack.pop()
+
+    def writeReport(self):
+        if not self.isActive():
+            return
+        fileName, self.fileName = self.fileName, None
+        os.listdir, __builtin__.open = self.origListdir, self.origOpen
+        wallEnd, cpuEnd = self.getTimes()
+        report = OrderedDict([ ("wall", round(wallEnd - self.startTimes[0], 6)), ("cpu", round(cpuEnd - self.startTimes[1], 6)),
+                               ("phases", self.records), ("counts", self.counts) ])
+        try:
+            import json
+            plugins.ensureDirExistsForFile(fileName)
+            with open(fileName, "w") as f:
+                json.dump(report, f, indent=2)
+        except (IOError, OSError), e:
+            plugins.printWarning("Could not write startup timing report to " + fileName + ": " + str(e))
+        sys.stdout.write(self.getSummary(report, fileName))
+
+    def getSummary(self, report, fileName):
+        lines = [ "Startup timing, written in full to " + fileName + ":" ]
+        self.addSummaryLines(lines, [ report ], "Total", 0)
+        for countName, count in report["counts"].items():
+            lines.append(countName.capitalize() + ": " + str(count))
+        return "\n".join(lines) + "\n"
+
+    def addSummaryLines(self, lines, records, title, depth):
+        for record in records:
+            name = record.get("name", title)
+            lines.append("%-50s %9.3fs wall %9.3fs cpu" % ("  " * depth + name, record["wall"], record["cpu"]))
+            self.addSummaryLines(lines, record.get("children", record.get("phases", [])), title, depth + 1)
+
+startupProfiler = StartupProfiler()
+
+
 # Class to allocate unique names to tests for script identification and cross process communication
 class UniqueNameFinder(plugins.Responder):
     def __init__(self, optionMap, *args):
@@ -110,7 +199,8 @@ class Activator(plugins.Responder, plugins.Observable):
         self.notify("StartRead")
         for suite in self.suites:
             try:
-                self.readTestSuiteContents(suite)
+                with startupProfiler.phase("read tests for " + suite.app.description()):
+                    self.readTestSuiteContents(suite)
                 self.diag.info("SUCCESS: Created test suite of size " + str(suite.size()))
 
                 if suite.size() > 0 or self.allowEmpty:
@@ -121,7 +211,11 @@ class Activator(plugins.Responder, plugins.Observable):
             except plugins.TextTestError, e:
                 rejectionInfo[suite.app] = str(e)
 
-        self.notify("AllRead", goodSuites)
+        for suite in self.suites:
+            suite.app.saveTestTreeIndex()
+        with startupProfiler.phase("notify AllRead"):
+            self.notify("AllRead", goodSuites)
+        startupProfiler.writeReport()
 
         if len(rejectionInfo) > 0:
             self.writeErrors(rejectionInfo)
@@ -190,6 +284,10 @@ class TextTest(plugins.Responder, plugins.Observable):
         # Just ignore any roots that don't exist
         self.inputOptions.rootDirectories = roots
         self.diag.info("Using test suite at " + repr(roots))
+        if self.inputOptions.has_key("warmstart"):
+            app = self.createApplicationFromSnapshot(self.inputOptions["warmstart"])
+            if app:
+                return False, [ app ]
         searchDirs = self.findSearchDirs(roots)
         if self.inputOptions.has_key("new"):
             return False, []
@@ -212,6 +310,15 @@ class TextTest(plugins.Responder, plugins.Observable):
         self.diag.info("Found applications : " + repr(appList))
         return raisedError, appList
 
+    def createApplicationFromSnapshot(self, fileName):
+        # No extra versions: processes started this way run the ones they're given
+        snapshot = testmodel.ApplicationSnapshot.read(fileName)
+        if snapshot and os.path.isdir(snapshot.dir):
+            self.diag.info("Creating application " + snapshot.name + " from snapshot at " + fileName)
+            return self.createApplication(snapshot.name, testmodel.DirectoryCache(snapshot.dir), snapshot.versions, snapshot)
+        else:
+            self.diag.info("Could not read application snapshot at " + fileName + ", finding applications as usual")
+
     def findMissingApps(self, appList, selectedApps):
         return filter(lambda appName: self.appMissing(appName, appList), selectedApps)
 
@@ -255,9 +362,10 @@ class TextTest(plugins.Responder, plugins.Observable):
                 appList.remove(toRemove)
         return raisedError, appList
 
-    def createApplication(self, appName, dircache, versions):
+    def createApplication(self, appName, dircache, versions, snapshot=None):
         try:
-            return testmodel.Application(appName, dircache, versions, self.inputOptions)
+            with startupProfiler.phase("application " + ".".join([ appName ] + versions)):
+                return testmodel.Application(appName, dircache, versions, self.inputOptions, snapshot=snapshot)
         except (testmodel.BadConfigError, plugins.TextTestError), e:
             sys.stderr.write("Unable to load application from file 'config." + appName +  "' - " + str(e) + ".\n")
 
@@ -332,7 +440,8 @@ class TextTest(plugins.Responder, plugins.Observable):
             appGroup = [ app ] + app.extras
             for partApp in appGroup:
                 try:
-                    testSuite = self.createInitialTestSuite(partApp)
+                    with startupProfiler.phase(partApp.description()):
+                        testSuite = self.createInitialTestSuite(partApp)
                     appSuites[partApp] = testSuite
                 except plugins.TextTestWarning, e:
                     warningMessages.append(partApp.rejectionMessage(str(e)))
@@ -376,7 +485,16 @@ class TextTest(plugins.Responder, plugins.Observable):
             pass # already written about this
 
     def _run(self):
-        appFindingWroteError, allApps = self.findApps()
+        if self.inputOptions.has_key("xs"):
+            startupProfiler.start(self.inputOptions.get("xs") or os.path.join(self.inputOptions.diagWriteDir, "startup_profile.json"))
+        try:
+            self.runWithProfiling()
+        finally:
+            startupProfiler.writeReport()
+
+    def runWithProfiling(self):
+        with startupProfiler.phase("findApps"):
+            appFindingWroteError, allApps = self.findApps()
         if self.inputOptions.helpMode():
             if len(allApps) > 0:
                 allApps[0].printHelpText()
@@ -413,10 +531,13 @@ class TextTest(plugins.Responder, plugins.Observable):
         return validOptions
 
     def createAndRunSuites(self, allApps):
-        self.createResponders(allApps)
-        raisedError, self.appSuites = self.createTestSuites(allApps)
+        with startupProfiler.phase("createResponders"):
+            self.createResponders(allApps)
+        with startupProfiler.phase("createTestSuites"):
+            raisedError, self.appSuites = self.createTestSuites(allApps)
         if not raisedError or len(self.appSuites) > 0:
-            self.addSuites(self.appSuites.values(), allApps)
+            with startupProfiler.phase("addSuites"):
+                self.addSuites(self.appSuites.values(), allApps)
 
             # Set the signal handlers to use when running, if we actually plan to do any
             self.setSignalHandlers(self.handleSignal)
@@ -434,7 +555,8 @@ class TextTest(plugins.Responder, plugins.Observable):
                 object.setObservers([ self ] + self.observers)
             suites = self.getSuitesToAdd(object, emptySuites, allApps)
             self.diag.info("Adding suites " + repr(suites) + " for " + str(object.__class__))
-            object.addSuites(suites)
+            with startupProfiler.phase(object.__class__.__name__):
+                object.addSuites(suites)
 
     def getSuitesToAdd(self, observer, emptySuites, allApps):
         for responderClass in self.getBuiltinResponderClasses():
@@ -510,8 +632,10 @@ class TextTest(plugins.Responder, plugins.Observable):
         # Make sure all of them are finished before we stop
         mainThreadRunner, subThreadRunners = self.findThreadRunners()
         allThreads = []
+        self.threadWakeup = plugins.Wakeup()
+        self.finishedThreads = []
         for subThreadRunner in subThreadRunners:
-            thread = Thread(target=subThreadRunner.run, name=subThreadRunner.__class__.__name__)
+            thread = Thread(target=self.runInThread, args=(subThreadRunner,), name=subThreadRunner.__class__.__name__)
             allThreads.append(thread)
             self.diag.info("Running " + str(subThreadRunner.__class__) + " in a subthread")
             thread.start()
@@ -522,27 +646,32 @@ class TextTest(plugins.Responder, plugins.Observable):
 
         self.waitForThreads(allThreads)
 
+    def runInThread(self, runner):
+        try:
+            runner.run()
+        finally:
+            self.finishedThreads.append(currentThread())
+            self.threadWakeup.wake()
+
     def waitForThreads(self, allThreads):
         # Need to wait for the threads to terminate in a way that allows signals to be
         # caught. thread.join doesn't do this. signal.pause seems like a good idea but
         # doesn't return unless a signal is caught, leading to sending "fake" ones from the
         # threads when they finish. And playing with signals and threads together is playing with fire...
 
-        # So we poll, which we don't really want to do, but it seems better than using Twisted or asyncore
-        # just for this :) With a long enough sleep it shouldn't generate too much load...
-
+        # So the threads wake us up via a pipe when they finish, which select can wait for without blocking signals
         # See http://groups.google.com/group/comp.lang.python/browse_thread/thread/a244905b86f06e48/7e969a0c7932fa91#
-        currThreads = self.aliveThreads(allThreads)
+        currThreads = self.unfinishedThreads(allThreads)
         threadCount = len(currThreads)
         while threadCount > 0:
-            sleep(0.5)
-            currThreads = self.aliveThreads(currThreads)
+            self.threadWakeup.wait()
+            currThreads = self.unfinishedThreads(currThreads)
             if len(currThreads) < threadCount:
                 self.diag.info("Thread(s) terminated, remaining are " + repr([ t.name for t in currThreads ]))
             threadCount = len(currThreads)
 
-    def aliveThreads(self, threads):
-        return filter(lambda thread: thread.isAlive(), threads)
+    def unfinishedThreads(self, threads):
+        return filter(lambda thread: thread not in self.finishedThreads, threads)
 
     def getSignals(self):
         if hasattr(signal, "SIGUSR1"):
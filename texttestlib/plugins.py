@@ -1,8 +1,8 @@
 
-import sys, os, logging.config, string, shutil, socket, time, re, stat, shlex, types, fnmatch, subprocess
+import sys, os, logging.config, string, shutil, socket, time, re, stat, shlex, types, fnmatch, subprocess, copy
 from ordereddict import OrderedDict
 from traceback import format_exception
-from threading import currentThread
+from threading import currentThread, Event
 from Queue import Queue, Empty
 from glob import glob
 from datetime import datetime
@@ -446,6 +446,10 @@ class Action:
     def callDuringAbandon(self, testArg):
         # set to True if tests should have this action called even after all is reckoned complete (e.g. UNRUNNABLE)
         return False
+    def makeParallelCopy(self):
+        # For running other tests at the same time. Keeps what setUpApplication found out,
+        # so override if information about the test being run is stored
+        return copy.copy(self)
     # Useful for printing in a certain format...
     def describe(self, testObj, postText = ""):
         log.info(testObj.getIndent() + repr(self) + " " + repr(testObj) + postText)
@@ -524,10 +528,15 @@ class Observable:
         self.passSelf = passSelf
 
     def addObserver(self, observer):
-        self.observers.append(observer)
+        # Not in place, the list may be shared with other observables
+        self.observers = self.observers + [ observer ]
 
     def setObservers(self, observers):
-        self.observers = filter(lambda x: x is not self, observers)
+        if any(x is self for x in observers):
+            self.observers = filter(lambda x: x is not self, observers)
+        else:
+            # Every test in a suite gets the same list, no need for a copy each
+            self.observers = observers
 
     def inMainThread(self):
         return currentThread().getName() == "MainThread"
@@ -1007,13 +1016,30 @@ def readList(filename):
     except IOError:
         return [] # It could be a broken link: don't bail out if so...
 
-def readListWithComments(filename, filterMethod=None):
+# Config and environment files are read again for every version of every application, and on every reload.
+# Keep what was read, and only read the file again if it looks different on disk
+configFileCache = {}
+def readConfigList(filename):
+    try:
+        statObj = os.stat(filename)
+    except OSError:
+        return []
+    statKey = statObj.st_mtime, statObj.st_ino, statObj.st_size
+    cached = configFileCache.get(filename)
+    if cached is None or cached[0] != statKey:
+        cached = statKey, tuple(readList(filename))
+        configFileCache[filename] = cached
+    return cached[1]
+
+def readListWithComments(filename, filterMethod=None, lines=None):
     items = OrderedDict()
     badItems = OrderedDict()
     currComment = ""
     emptyLineSymbol = "__EMPTYLINE__"
+    if lines is None:
+        lines = open(filename).readlines()
 
-    for longline in open(filename).readlines():
+    for longline in lines:
         line = longline.strip()
         if len(line) == 0:
             if currComment:
@@ -1081,6 +1107,45 @@ def retryOnInterrupt(function, *args):
         else:
             raise
 
+class Wakeup:
+    """ Lets one thread sleep until another wakes it up, or until a timeout, without polling.
+    Waits on a pipe, so waiting in the main thread still lets signals be handled. """
+    def __init__(self):
+        if os.name == "posix":
+            import fcntl
+            self.readFd, self.writeFd = os.pipe()
+            # Waking up repeatedly when nobody is waiting must not fill the pipe and block
+            fcntl.fcntl(self.writeFd, fcntl.F_SETFL, fcntl.fcntl(self.writeFd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        else:
+            # select doesn't work on pipes on Windows
+            self.event = Event()
+
+    def wake(self):
+        if os.name == "posix":
+            try:
+                os.write(self.writeFd, "x")
+            except OSError: # pipe full, so it will wake anyway
+                pass
+        else:
+            self.event.set()
+
+    def wait(self, timeout=None):
+        # Returns True if woken up, False on timeout or signal
+        if os.name == "posix":
+            import select
+            try:
+                ready = select.select([ self.readFd ], [], [], timeout)[0]
+            except select.error: # interrupted by a signal
+                return False
+            if ready:
+                os.read(self.readFd, 4096)
+            return bool(ready)
+        else:
+            woken = self.event.wait(0.5 if timeout is None else timeout) # Can't catch signals while blocking completely
+            self.event.clear()
+            return bool(woken)
+
+
 def tryFileChange(function, permissionMessage, *args):
     try:
         return function(*args)
@@ -1369,7 +1434,7 @@ class MultiEntryDictionary(OrderedDict):
     def readFromFile(self, filename, *args, **kwargs):
         self.diag.info("Reading file " + filename)
         currSectionName = ""
-        for line in readList(filename):
+        for line in readConfigList(filename):
             if self.allowSectionHeaders and self.isSectionHeader(line):
                 currSectionName = self.getNewSectionInfo(line, *args, **kwargs)
             elif ":" in line:
@@ -3,7 +3,7 @@
 Module for the queuesystem configuration, i.e. using grid engines to run tests in parallel
 """
 
-import masterprocess, slavejobs, utils, os
+import masterprocess, slavejobs, workerthreads, utils, os
 from texttestlib import plugins, default
 from texttestlib.default.virtualdisplay import VirtualDisplayResponder
 from texttestlib.default.storytext_interface import ApplicationEventResponder
@@ -19,6 +19,8 @@ class QueueSystemConfig(default.Config):
     def __init__(self, *args):
         default.Config.__init__(self, *args)
         self.useQueueSystem = False
+        self.useWorkerThreads = False
+        self.useMasterShards = False
         
     def getRunningGroupNames(self, app):
         groups = default.Config.getRunningGroupNames(self, app)
@@ -74,6 +76,8 @@ class QueueSystemConfig(default.Config):
             elif group.name.startswith("Invisible"):
                 group.addOption("slave", "Private: used to submit slave runs remotely")
                 group.addOption("servaddr", "Private: used to submit slave runs remotely")
+                group.addOption("warmstart", "Private: used to start slave runs from the master's snapshot of the application")
+                group.addOption("submaster", "Private: used to run some of the tests on behalf of another master process")
                 group.addOption("home", "Private: used to communicate local home directory to environments that run as a different user")
                 
     def absCheckout(self, location, checkout, isSpecific):
@@ -129,6 +133,10 @@ class QueueSystemConfig(default.Config):
             else:
                 return True
             
+    def calculateUseWorkerThreads(self, allApps):
+        return utils.useLocalQueueSystem(allApps) and \
+               all((app.getConfigValue("queue_system_local_workers") == "thread" for app in allApps))
+            
     def getRemoteTestTmpDir(self, test):
         qs = masterprocess.QueueSystemServer.instance
         if qs:
@@ -138,17 +146,28 @@ class QueueSystemConfig(default.Config):
         return default.Config.getRemoteTestTmpDir(self, test)
     
     def hasExplicitInterface(self):
-        return self.slaveRun() or default.Config.hasExplicitInterface(self)
+        return self.slaveRun() or self.subMasterRun() or default.Config.hasExplicitInterface(self)
 
     def slaveRun(self):
         return self.optionMap.has_key("slave")
 
+    def subMasterRun(self):
+        return self.optionMap.has_key("submaster")
+
     def getWriteDirectoryName(self, app):
-        return self.optionMap.get("slave") or default.Config.getWriteDirectoryName(self, app)
+        return self.optionMap.get("slave") or self.optionMap.get("submaster") or default.Config.getWriteDirectoryName(self, app)
     
     def getLocalWriteDirectoryName(self, app):
         return default.Config.getWriteDirectoryName(self, app)
     
+    def testFilesPending(self, test):
+        qs = masterprocess.QueueSystemServer.instance
+        return qs is not None and qs.testFilesPending(test)
+
+    def waitForTestFiles(self, test):
+        qs = masterprocess.QueueSystemServer.instance
+        return qs is not None and qs.waitForTestFiles(test)
+
     def noFileAdvice(self):
         if self.useQueueSystem:
             return "Try re-running the test, and either use local mode, or check the box for keeping\n" + \
@@ -156,6 +175,9 @@ class QueueSystemConfig(default.Config):
         else:
             return ""
 
+    def recordsTestTree(self, app):
+        return not self.slaveRun() and app.getConfigValue("queue_system_slave_warm_start") > 0
+
     def getExtraVersions(self, app):
         if self.slaveRun():
             if self.isReconnecting():
@@ -167,7 +189,7 @@ class QueueSystemConfig(default.Config):
             return default.Config.getExtraVersions(self, app)
 
     def keepTemporaryDirectories(self):
-        if self.hasKeeptmpFlag():
+        if self.hasKeeptmpFlag() or self.subMasterRun(): # the coordinating master owns the write directory
             return True
         if self.slaveRun():
             if self.useCloud:
@@ -177,14 +199,19 @@ class QueueSystemConfig(default.Config):
         return default.Config.keepTemporaryDirectories(self)
         
     def cleanPreviousTempDirs(self):
-        return not self.slaveRun() and default.Config.cleanPreviousTempDirs(self)
+        return not self.slaveRun() and not self.subMasterRun() and default.Config.cleanPreviousTempDirs(self)
 
     def readsTestStateFiles(self):
         # Reads the data via a socket, need to set up categories
         return default.Config.readsTestStateFiles(self) or (self.useQueueSystem and not self.slaveRun())
 
     def cleanSlaveFiles(self, test):
-        if self.useCloud:
+        if self.useCloud and test.getConfigValue("queue_system_result_transfer") == "differences" and \
+               test.state.hasResults() and not test.state.hasSucceeded() and not self.optionMap.has_key("keepslave") and \
+               not self.optionMap.has_key("keeptmp"):
+            # Only the differences were transferred, the master fetches the rest from here and then removes it
+            return
+        elif self.useCloud:
             # Don't keep anything on a remote system, we've transferred it all back anyhow...
             writeDir = test.getDirectory(temporary=1)
             plugins.rmtree(writeDir)
@@ -250,6 +277,9 @@ class QueueSystemConfig(default.Config):
         return [ "c", "b", "trace", "ignorecat", "ignorefilters", "delay", "screenshot", "gui", "td",
                  "rectraffic", "keeptmp", "keepslave", "reconnect", "reconnfull", "rerun" ]
 
+    def getSubMasterSwitches(self):
+        return self.getSlaveSwitches() + [ "R", "q", "perf", "xs" ]
+
     def getExecHostFinder(self):
         if self.slaveRun():
             return slavejobs.FindExecutionHostsInSlave()
@@ -275,23 +305,40 @@ class QueueSystemConfig(default.Config):
         classes.append(ApplicationEventResponder)
         return classes
 
+    def getSubMasterResponderClasses(self):
+        # An ordinary master, except that the coordinating master takes care of reporting
+        return [ self.getTextDisplayResponderClass(), slavejobs.SubMasterResponder ] + self.getThreadActionClasses()
+
     def _getResponderClasses(self, allApps, *args):
         self.useQueueSystem = self.calculateUseQueueSystem(allApps)
+        if self.useQueueSystem and self.calculateUseWorkerThreads(allApps):
+            # Tests run in this process, so it should behave as for running tests directly
+            self.useQueueSystem = False
+            self.useWorkerThreads = True
         if self.useQueueSystem and not self.cloudUseConsistent(allApps):
             raise plugins.TextTestError, "No support currently for running ec2cloud tests at the same time as tests with other queue systems"
+        self.useMasterShards = self.useQueueSystem and not self.subMasterRun() and \
+                               max((app.getConfigValue("queue_system_master_shards") for app in allApps)) > 1
         
         if self.slaveRun():
             return self.getSlaveResponderClasses()
+        elif self.subMasterRun():
+            return self.getSubMasterResponderClasses()
         else:
             return default.Config._getResponderClasses(self, allApps, *args)
         
     def getThreadActionClasses(self):
         if self.useQueueSystem:
             return [ self.getSlaveServerClass(), self.getQueueServerClass() ] # don't use the action runner at all!
+        elif self.useWorkerThreads:
+            return [ workerthreads.WorkerThreadActionRunner ]
         else:
             return default.Config.getThreadActionClasses(self)
     def getQueueServerClass(self):
-        return masterprocess.QueueSystemServer
+        if self.useMasterShards:
+            return masterprocess.ShardCoordinator
+        else:
+            return masterprocess.QueueSystemServer
     def getSlaveServerClass(self):
         return masterprocess.SlaveServerResponder
     def useVirtualDisplay(self):
@@ -351,6 +398,10 @@ class QueueSystemConfig(default.Config):
         app.setConfigDefault("performance_test_resource", { "default" : [] }, "Resources to request from queue system for performance testing")
         app.setConfigDefault("parallel_environment_name", "*", "(SGE) Which SGE parallel environment to use when SUT is parallel")
         app.setConfigDefault("queue_system_max_capacity", self.defaultMaxCapacity, "Maximum possible number of parallel tests to run")
+        app.setConfigDefault("queue_system_adaptive_capacity", 0, "(local) Vary the number of parallel tests according to load average and free memory, instead of using the number of CPUs")
+        app.setConfigDefault("queue_system_min_capacity", 1, "(local) Minimum number of parallel tests to run with queue_system_adaptive_capacity")
+        app.setConfigDefault("queue_system_local_workers", "process", "(local) How to run tests in parallel: \"process\" to start a TextTest slave process for each, \"thread\" to run them in worker threads of the main process")
+        app.setConfigDefault("queue_system_slave_idle_timeout", 0, "Seconds a slave job waits for a new test it can run before terminating, when none is available straight away")
         app.setConfigDefault("queue_system_max_reruns", { "default" : self.defaultMaxReruns }, "Maximum number of times to rerun tests due to known bugs")
         app.setConfigDefault("queue_system_min_test_count", 0, "Minimum number of tests before it's worth submitting them to the grid")
         app.setConfigDefault("queue_system_resource", [], "Grid engine resources required to locate test execution machines")
@@ -359,6 +410,12 @@ class QueueSystemConfig(default.Config):
         app.setConfigDefault("queue_system_submit_args", "", "Additional arguments to provide to grid engine submission command")
         app.setConfigDefault("queue_system_proxy_executable", "", "Executable to run as a proxy for the real test program")
         app.setConfigDefault("queue_system_proxy_resource", [], "Grid engine resources required to locate machine to run proxy process")
+        app.setConfigDefault("queue_system_submission_order", "tree", "Order to submit tests in: \"tree\" for test suite order, \"longest_first\" to submit those expected to take longest first")
+        app.setConfigDefault("queue_system_default_duration", -1.0, "Expected duration (seconds) of tests without history or performance files, when submitting longest first. Default is the average of the others")
+        app.setConfigDefault("queue_system_duration_file", "", "File to store test durations in, for submitting longest first. Default is under the personal config directory")
+        app.setConfigDefault("queue_system_slave_warm_start", 0, "Start slaves from a snapshot of the configuration and test tree written by the master, instead of having each find and read them again")
+        app.setConfigDefault("queue_system_master_shards", 0, "Number of master processes to divide the tests between, for very large runs. Each submits its share to the queue system, and this one collects the results")
+        app.setConfigDefault("queue_system_result_transfer", "sandbox", "(ec2cloud) Files to send back from slaves for failed tests: \"sandbox\" for all of them, \"differences\" for those that differ, leaving the rest on the slave machine to be fetched if needed")
         app.setConfigDefault("queue_system_core_file_location", "", "System-wide location for core files from grid jobs, in case TEXTTEST_TMP is generated")
         app.addConfigEntry("builtin", "proxy_options", "definition_file_stems")
         
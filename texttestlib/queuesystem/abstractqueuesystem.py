@@ -1,14 +1,17 @@
 
 """ Base class for all the queue system implementations """
 
-import subprocess, os, sys
+import subprocess, os, sys, time, tempfile
 from texttestlib import plugins
+from texttestlib.utils import getUserName
 
 class QueueSystem(object):
+    lastSubmitTime = 0
     def __init__(self, *args):
         pass
     
     def submitSlaveJob(self, cmdArgs, slaveEnv, logDir, submissionRules, jobType):
+        self.lastSubmitTime = time.time()
         try:
             process = subprocess.Popen(cmdArgs, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                                        cwd=logDir, env=self.getSlaveEnvironment(slaveEnv), 
@@ -25,6 +28,56 @@ class QueueSystem(object):
     def supportsPolling(self):
         return True
 
+    def getStatusForAllJobs(self, jobIds):
+        output = self.getCachedStatusOutput()
+        if output is not None: # queue system not available for some reason
+            return self.parseStatusOutput(output, jobIds)
+
+    def getStatusOutput(self):
+        pass # Implemented by queue systems that support polling
+
+    def getStatusCacheFile(self):
+        return os.path.join(tempfile.gettempdir(), "texttest_" + self.__class__.__module__.split(".")[-1] + "_status." + getUserName())
+
+    def getCachedStatusOutput(self):
+        # All masters run by the same user on this machine share the status output,
+        # so they query the queue system at most once between them every so often
+        maxAge = float(os.getenv("TEXTTEST_QS_STATUS_CACHE_TIME", "10"))
+        if maxAge <= 0 or os.name != "posix":
+            return self.getStatusOutput()
+
+        import fcntl
+        cacheFile = self.getStatusCacheFile()
+        with open(cacheFile + ".lock", "w") as lockFile:
+            # Anyone else fetching it right now will be finished when we get the lock
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            output = self.readStatusCache(cacheFile, maxAge)
+            if output is None:
+                queryTime = time.time()
+                output = self.getStatusOutput()
+                if output is not None:
+                    self.writeStatusCache(cacheFile, queryTime, output)
+            return output
+
+    def readStatusCache(self, cacheFile, maxAge):
+        try:
+            with open(cacheFile) as f:
+                queryTime = float(f.readline())
+                # Must have been fetched after we last submitted, or our new job would be missing
+                if queryTime > self.lastSubmitTime and time.time() - queryTime < maxAge:
+                    return f.read()
+        except (IOError, ValueError):
+            pass
+
+    def writeStatusCache(self, cacheFile, queryTime, output):
+        tmpFile = cacheFile + "." + str(os.getpid())
+        with open(tmpFile, "w") as f:
+            f.write(repr(queryTime) + "\n" + output)
+        os.rename(tmpFile, cacheFile)
+
+    def prefetchJobFailureInfo(self, jobIds):
+        pass # For queue systems that can look up several jobs at once
+
     def findErrorMessage(self, stderr, *args):
         if len(stderr) > 0:
             basicError = self.findSubmitError(stderr)
@@ -51,12 +104,18 @@ class QueueSystem(object):
     
     def getCapacity(self):
         pass # treated as no restriction
+
+    def hasAdaptiveCapacity(self):
+        return False # capacity only ever goes down
     
     def setRemoteProcessId(self, *args):
         pass # only cloud cares about this
     
     def getRemoteTestMachine(self, *args):
         pass # only cloud cares about this
+
+    def setFilesPending(self, *args):
+        pass # only cloud cares about this
     
     def cleanup(self, *args):
         return True # only cloud cares about this
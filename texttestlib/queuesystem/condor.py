@@ -50,16 +50,19 @@ class QueueSystem(abstractqueuesystem.QueueSystem):
         else:
             return resultOutput
 
-    def getStatusForAllJobs(self):
-        statusDict = {}
+    def getStatusOutput(self):
         proc = subprocess.Popen(['condor_q', '-format', '%s ', 'ClusterId', '-format', '%s\\n', 'JobStatus' ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        outMsg = proc.communicate()[0]
+        return proc.communicate()[0]
+
+    def parseStatusOutput(self, outMsg, jobIds):
+        statusDict = {}
         for line in outMsg.splitlines():
             words = line.split()
-            statusLetter = words[1]
-            status = self.allStatuses.get(statusLetter)
-            if status:
-                statusDict[words[0]] = status
+            if words[0] in jobIds:
+                statusLetter = words[1]
+                status = self.allStatuses.get(statusLetter)
+                if status:
+                    statusDict[words[0]] = status
         return statusDict        
 
     def killJob(self, jobId):
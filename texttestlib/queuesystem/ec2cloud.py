@@ -28,6 +28,7 @@ class Ec2Machine:
         self.errorMessage = ""
         self.subprocessLock = subprocessLock
         self.startMethod = None if alreadyRunning else inst.start
+        self.pendingFileJobs = set()
         
     def getNextJobId(self):
         return "job" + str(len(self.remoteProcessInfo)) + "_" + self.ip
@@ -129,6 +130,9 @@ class Ec2Machine:
         if self.thread.isAlive():
             self.queue.put((None, None))
             return True
+
+        if self.pendingFileJobs:
+            return True # The master is still fetching files from here
         
         for localPid, _ in self.remoteProcessInfo.values():
             if localPid in processes:
@@ -471,6 +475,14 @@ class QueueSystem(local.QueueSystem):
         if machine:
             return machine.fullMachine
 
+    def setFilesPending(self, jobId, pending):
+        machine = self.getMachine(jobId)
+        if machine:
+            if pending:
+                machine.pendingFileJobs.add(jobId)
+            else:
+                machine.pendingFileJobs.discard(jobId)
+
     def killRemoteProcess(self, jobId):
         machine = self.getMachine(jobId)
         if machine:
@@ -482,8 +494,8 @@ class QueueSystem(local.QueueSystem):
         machine = self.getMachine(jobId, includeReleased=True)
         return machine.errorMessage if machine else ""
     
-    def getStatusForAllJobs(self):
-        procStatus = super(QueueSystem, self).getStatusForAllJobs()
+    def getStatusForAllJobs(self, jobIds):
+        procStatus = super(QueueSystem, self).getStatusForAllJobs(jobIds)
         jobStatus = {}
         for machine in self.machines:
             machine.collectJobStatus(jobStatus, procStatus)
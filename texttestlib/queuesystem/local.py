@@ -1,14 +1,29 @@
 
 """ Base class for all the queue system implementations """
 
-import subprocess, os, signal
+import subprocess, os, signal, logging, re
 import abstractqueuesystem
 from multiprocessing import cpu_count
+from threading import Lock
 from texttestlib import plugins
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
 
 class QueueSystem(abstractqueuesystem.QueueSystem):
-    def __init__(self, *args):
+    memoryResourcePattern = re.compile("^(?:mem|mem_free|h_vmem|virtual_free)=([0-9.]+)([KMGT]?)B?$", re.IGNORECASE)
+    def __init__(self, test=None):
         self.processes = {}
+        self.adaptive = test is not None and test.getConfigValue("queue_system_adaptive_capacity")
+        if self.adaptive:
+            self.minCapacity = test.getConfigValue("queue_system_min_capacity")
+            # Allow for I/O-bound tests that don't keep a CPU busy
+            self.maxCapacity = min(test.getConfigValue("queue_system_max_capacity"), 2 * cpu_count())
+        self.expectedMemory = {}
+        self.peakMemory = None
+        self.pollLock = Lock()
+        self.diag = logging.getLogger("Local Queue Capacity")
 
     def submitSlaveJob(self, cmdArgs, slaveEnv, logDir, submissionRules, jobType):
         outputFile, errorsFile = submissionRules.getJobFiles()
@@ -26,10 +41,70 @@ class QueueSystem(abstractqueuesystem.QueueSystem):
         else:
             jobId = str(process.pid)
             self.processes[jobId] = process
+            memoryHint = self.findMemoryHint(submissionRules.findResourceList())
+            if memoryHint:
+                self.expectedMemory[jobId] = memoryHint
             return jobId, None
+
+    def findMemoryHint(self, resources):
+        for resource in resources:
+            match = self.memoryResourcePattern.match(resource.strip())
+            if match:
+                number, unit = match.groups()
+                return float(number) * 1024 ** "BKMGT".index(unit.upper() or "B")
+
+    def hasAdaptiveCapacity(self):
+        return self.adaptive
         
     def getCapacity(self):
-        return cpu_count()
+        if not self.adaptive:
+            return cpu_count()
+
+        running = self.findRunningJobs()
+        if hasattr(os, "getloadavg"):
+            # Load average includes our own running slaves
+            capacity = len(running) + int(round(cpu_count() - os.getloadavg()[0]))
+            self.diag.info(str(len(running)) + " slaves running, capacity from load average is " + str(capacity))
+        else:
+            capacity = cpu_count()
+        availableMemory = self.getAvailableMemory()
+        memoryPerSlave = self.getExpectedMemoryPerSlave(running)
+        if availableMemory is not None and memoryPerSlave:
+            memoryCapacity = len(running) + int(availableMemory / memoryPerSlave)
+            self.diag.info(str(availableMemory) + " bytes of memory available, " + str(memoryPerSlave) +
+                           " expected per slave, capacity from memory is " + str(memoryCapacity))
+            capacity = min(capacity, memoryCapacity)
+        return max(self.minCapacity, min(capacity, self.maxCapacity))
+
+    def findRunningJobs(self):
+        return [ jobId for jobId in self.processes.keys() if self.pollJob(jobId) is None ]
+
+    def pollJob(self, jobId):
+        proc = self.processes[jobId]
+        # Several threads poll. If two of them wait for the same process at once, Popen decides it exited with 0 in one of them
+        with self.pollLock:
+            if proc.returncode is not None:
+                return proc.returncode
+            returnCode = proc.poll()
+            if returnCode is not None and self.adaptive and resource is not None:
+                # The largest of the processes we've waited for, including the tests they ran. Linux reports it in kilobytes
+                self.peakMemory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+            return returnCode
+
+    def getExpectedMemoryPerSlave(self, running):
+        hints = [ self.expectedMemory[jobId] for jobId in running if jobId in self.expectedMemory ]
+        if self.peakMemory:
+            hints.append(self.peakMemory)
+        if hints:
+            return max(hints)
+
+    def getAvailableMemory(self):
+        try:
+            for line in open("/proc/meminfo"):
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+        except IOError:
+            pass # Not Linux, don't know
         
     def formatCommand(self, cmdArgs):
         return " ".join(cmdArgs)
@@ -39,7 +114,7 @@ class QueueSystem(abstractqueuesystem.QueueSystem):
         
     def killJob(self, jobId):
         proc = self.processes[jobId]
-        jobExisted = proc.poll() is None
+        jobExisted = self.pollJob(jobId) is None
         if jobExisted:
             if os.name == "posix":
                 proc.send_signal(self.getSignal())
@@ -51,10 +126,10 @@ class QueueSystem(abstractqueuesystem.QueueSystem):
     def runTaskKill(self, proc, extraArgs=[]):
         return subprocess.call([ "taskkill" ] + extraArgs + [ "/PID", str(proc.pid) ], stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT, startupinfo=plugins.getHideStartUpInfo()) == 0
     
-    def getStatusForAllJobs(self):
+    def getStatusForAllJobs(self, jobIds):
         statusDict = {}
-        for procId, process in self.processes.items():
-            if process.poll() is None:
+        for procId in self.processes.keys():
+            if self.pollJob(procId) is None:
                 statusDict[procId] = "RUN", "Running"
         return statusDict
     
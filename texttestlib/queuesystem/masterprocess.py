@@ -3,19 +3,22 @@
 Code to do with the grid engine master process, i.e. submitting slave jobs and waiting for them to report back
 """
 
-import os, sys, socket, signal, logging, time
+import os, sys, socket, signal, logging, time, tarfile, subprocess
 from utils import *
-from Queue import Queue
+from Queue import Queue, Empty
 from SocketServer import ThreadingTCPServer, StreamRequestHandler
-from threading import RLock, Lock
+from threading import Thread, RLock, Lock, Event
 from ordereddict import OrderedDict
-from texttestlib import plugins
+from texttestlib import plugins, testmodel
 from texttestlib.default.console import TextDisplayResponder, InteractiveResponder
 from texttestlib.default.knownbugs import CheckForBugs
 from texttestlib.default.actionrunner import BaseActionRunner
 from texttestlib.default.performance import getTestPerformance
+from texttestlib.default.remotecopy import RemoteCopyManager
 from types import StringType
 from glob import glob
+from cStringIO import StringIO
+from cPickle import PicklingError
 
 plugins.addCategory("abandoned", "abandoned", "were abandoned")
 
@@ -36,8 +39,53 @@ class Pending(plugins.TestState):
             return self.__class__(newFreeText, newRunStatus, lifecycleChange)
 
 
+# Expected run times of tests, used to submit the longest ones first.
+# Taken from how long each test took to complete in previous runs, or the approved performance files if there aren't any
+class ExpectedDurations:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.durations = {}
+        self.changed = False
+        badLines = []
+        for line in plugins.readList(fileName):
+            try:
+                relPath, duration = line.rsplit(":", 1)
+                self.durations[relPath] = float(duration)
+            except ValueError:
+                badLines.append(line)
+        if badLines:
+            # Only an ordering hint, not worth stopping the run for
+            plugins.printWarning("Ignoring lines in test duration file at " + fileName + " not of the form <test path>:<seconds> :\n" +
+                                 "\n".join(badLines))
+
+    def getExpected(self, test):
+        duration = self.durations.get(test.getRelPath())
+        if duration is not None:
+            return duration
+        perf = getTestPerformance(test)
+        if perf >= 0:
+            return perf
+
+    def record(self, test, duration):
+        relPath = test.getRelPath()
+        previous = self.durations.get(relPath)
+        # Smooth out the odd slow run on a busy machine
+        self.durations[relPath] = duration if previous is None else (previous + duration) / 2
+        self.changed = True
+
+    def write(self):
+        if self.changed:
+            plugins.ensureDirExistsForFile(self.fileName)
+            with open(self.fileName, "w") as f:
+                for relPath in sorted(self.durations.keys()):
+                    f.write(relPath + ":" + str(round(self.durations[relPath], 3)) + "\n")
+            self.changed = False
+
+
 class QueueSystemServer(BaseActionRunner):
     instance = None
+    # Put in the reuse failure queue to wake up the submission thread, unlike a terminator it won't stop it
+    capacityGrown = object()
     def __init__(self, optionMap, allApps):
         BaseActionRunner.__init__(self, optionMap, logging.getLogger("Queue System Submit"))
         # queue for putting tests when we couldn't reuse the originals
@@ -59,6 +107,21 @@ class QueueSystemServer(BaseActionRunner):
         self.slaveLogDirs = set()
         self.delayedTestsForAdd = []
         self.remainingForApp = OrderedDict()
+        self.orderByDuration = any((app.getConfigValue("queue_system_submission_order") == "longest_first" for app in allApps))
+        self.expectedDurations = {}
+        self.testStartTimes = {}
+        self.pollWakeup = plugins.Wakeup()
+        # Slaves waiting for a test they can run, rather than terminating
+        self.idleSlaves = OrderedDict()
+        self.idleLock = Lock()
+        self.slaveIdleTimeout = max((app.getConfigValue("queue_system_slave_idle_timeout") for app in allApps))
+        # Tests whose remaining files are being fetched from where they ran. The events are set when they're here
+        self.fileFetchEvents = {}
+        self.fileFetchQueue = Queue()
+        self.fileFetchThread = None
+        self.fileFetchLock = Lock()
+        self.snapshotLock = Lock()
+        self.snapshotFiles = {}
         appCapacities = []
         for app in allApps:
             appCapacity = self.maxCapacity
@@ -94,6 +157,10 @@ class QueueSystemServer(BaseActionRunner):
     def addTest(self, test):
         if self.createDirectories:
             test.makeWriteDirectory()
+        if self.orderByDuration and not self.allRead:
+            # Can only order them when we know what they all are
+            self.delayedTestsForAdd.append(test)
+            return
         capacityForApp = self.remainingForApp[test.app.name]
         if capacityForApp > 0:
             self.addTestToQueues(test)
@@ -108,8 +175,11 @@ class QueueSystemServer(BaseActionRunner):
         # Clear out the previous job reference, otherwise our grid polling will kill it off
         self.jobs[test] = []
         self.addTestToQueues(test)
+        self.pollWakeup.wake()
 
     def addTestToQueues(self, test):
+        if self.handOffToIdleSlave(test):
+            return
         with self.counterLock:
             self.testCount += 1
         queue = self.findQueueForTest(test)
@@ -117,14 +187,46 @@ class QueueSystemServer(BaseActionRunner):
             queue.put(test)
 
     def addDelayedTests(self):
+        if self.orderByDuration:
+            self.sortByExpectedDuration(self.delayedTestsForAdd)
         for test in self.delayedTestsForAdd:
             self.addTestToQueues(test)
         self.delayedTestsForAdd = []
 
+    def getExpectedDurations(self, app):
+        if app not in self.expectedDurations:
+            fileName = app.getConfigValue("queue_system_duration_file") or \
+                       os.path.join(plugins.getPersonalDir("queue_durations"), app.name + app.versionSuffix())
+            self.expectedDurations[app] = ExpectedDurations(os.path.expanduser(fileName))
+        return self.expectedDurations[app]
+
+    def sortByExpectedDuration(self, tests):
+        expected = {}
+        for test in tests:
+            expected[test] = self.getExpectedDurations(test.app).getExpected(test)
+        known = [ duration for duration in expected.values() if duration is not None ]
+        averageDuration = sum(known) / len(known) if known else 0.0
+        for test in tests:
+            if expected[test] is None:
+                defaultDuration = test.getConfigValue("queue_system_default_duration")
+                expected[test] = defaultDuration if defaultDuration >= 0 else averageDuration
+        # Stable sort, so equal tests stay in tree order
+        tests.sort(key=lambda test: expected[test], reverse=True)
+        self.diag.info("Submission order by expected duration : " + repr([ (test.uniqueName, expected[test]) for test in tests ]))
+
+    def notifyLifecycleChange(self, test, state, changeDesc):
+        if not self.orderByDuration or self.optionMap.has_key("submaster"):
+            return # The coordinating master records the durations, it sees all the results
+        if changeDesc == "start":
+            self.testStartTimes[test] = time.time()
+        elif changeDesc == "complete" and test in self.testStartTimes and state.category not in [ "killed", "cancelled" ]:
+            duration = time.time() - self.testStartTimes.pop(test)
+            self.getExpectedDurations(test.app).record(test, duration)
+
     def notifyAllRead(self, suites):
+        self.allRead = True
         self.addDelayedTests()
         BaseActionRunner.notifyAllRead(self, suites)
-        self.allRead = True
 
     def run(self): # picked up by core to indicate running in a thread
         self.runAllTests()
@@ -137,23 +239,21 @@ class QueueSystemServer(BaseActionRunner):
 
     def pollQueueSystem(self):
         # Start by polling after 5 seconds, ever after try every 15
-        interval = float(os.getenv("TEXTTEST_QS_POLL_INTERVAL", "0.5")) # Amount of time to wait between checks for exit/completion when polling grid/cloud
-        attempts = int(float(os.getenv("TEXTTEST_QS_POLL_WAIT", "5")) / interval) # Amount of time to wait before initiating polling of grid/cloud
-        subsequentAttempts = int(float(os.getenv("TEXTTEST_QS_POLL_SUBSEQUENT_WAIT", "15")) / interval) # Amount of time to wait before subsequent polling of grid/cloud
-        if attempts >= 0: 
+        waitTime = float(os.getenv("TEXTTEST_QS_POLL_WAIT", "5")) # Amount of time to wait before initiating polling of grid/cloud
+        subsequentWaitTime = float(os.getenv("TEXTTEST_QS_POLL_SUBSEQUENT_WAIT", "15")) # Amount of time to wait before subsequent polling of grid/cloud
+        if waitTime >= 0: 
             while True:
-                for _ in range(attempts):
-                    time.sleep(interval)
-                    if self.allComplete:
-                        return
-                    if self.exited:
-                        break
-                if not self.exited:
-                    self.updateJobStatus()
-                attempts = subsequentAttempts
-                self.diag.info("Trying to rerun queues " + repr(self.testsSubmitted) + " out of " + repr(self.maxCapacity) + " tests submitted")
-                # In case any tests have had reruns triggered since we stopped submitting
-                self.runQueue(self.getTestForRun, self.runTest, "rerunning", block=False)
+                pollTime = time.time() + waitTime
+                # Woken up early when everything completes, we're killed or tests need rerunning
+                while not self.allComplete and (self.exited or time.time() < pollTime):
+                    self.pollWakeup.wait(None if self.exited else pollTime - time.time())
+                    self.diag.info("Trying to rerun queues " + repr(self.testsSubmitted) + " out of " + repr(self.maxCapacity) + " tests submitted")
+                    # In case any tests have had reruns triggered since we stopped submitting
+                    self.runQueue(self.getTestForRun, self.runTest, "rerunning", block=False)
+                if self.allComplete:
+                    return
+                self.updateJobStatus()
+                waitTime = subsequentWaitTime
 
     def canPoll(self):
         queueSystem = self.getQueueSystem(self.jobs.keys()[0])
@@ -161,9 +261,11 @@ class QueueSystemServer(BaseActionRunner):
     
     def updateJobStatus(self):
         queueSystem = self.getQueueSystem(self.jobs.keys()[0])
-        statusInfo = queueSystem.getStatusForAllJobs()
+        jobIds = set((jobId for jobs in self.jobs.values() for jobId, _ in jobs))
+        statusInfo = queueSystem.getStatusForAllJobs(jobIds)
         self.diag.info("Got status for all jobs : " + repr(statusInfo))
         if statusInfo is not None: # queue system not available for some reason
+            lostJobs = []
             for test, jobs in self.jobs.items():
                 if not test.state.isComplete():
                     for jobId, jobName in jobs:
@@ -174,7 +276,12 @@ class QueueSystemServer(BaseActionRunner):
                             self.updateRunStatus(test, status)
                         elif not status and not self.jobCompleted(test, jobName):
                             # Do this to any jobs
-                            self.setSlaveFailed(test, self.jobStarted(test, jobName), True, jobId)
+                            lostJobs.append((test, jobId, jobName))
+            if lostJobs:
+                # Look them all up at once, the failure information needs accounting queries
+                queueSystem.prefetchJobFailureInfo([ jobId for _, jobId, _ in lostJobs ])
+            for test, jobId, jobName in lostJobs:
+                self.setSlaveFailed(test, self.jobStarted(test, jobName), True, jobId)
         
     def updateRunStatus(self, test, status):
         newRunStatus, newExplanation = status
@@ -209,28 +316,18 @@ class QueueSystemServer(BaseActionRunner):
                 newTestName = newTest.uniqueName if newTest else " no test."
                 self.diag.info("Repeating answer: using slave from " + test.uniqueName + " for " + newTestName)
                 return newTest
-            # Don't allow this to use up the terminator
-            newTest = self.getTest(block=False, replaceTerminators=True)
-            if newTest:
-                if tryReuse and self.allowReuse(test, state, newTest):
-                    if not doneRerun:
-                        self.reusedTests[test] = newTest
-                    self.jobs[newTest] = self.getJobInfo(test)
-                    with self.counterLock:
-                        if self.testCount > 1:
-                            self.testCount -= 1
-                            postText = self.remainStr()
-                        else:
-                            # Don't allow test count to drop to 0 here, can cause race conditions
-                            self.submitTerminators() 
-                            postText = ": submitting terminators as final test"
-                    self.diag.info("Reusing slave from " + test.uniqueName + " for " + newTest.uniqueName + postText)
-                    return newTest
-                else:
-                    self.diag.info("Adding to reuse failure queue : " + newTest.uniqueName)
-                    self.reuseFailureQueue.put(newTest)
+            if self.adaptCapacity(test):
+                # Let this slave terminate, there are too many running
+                newTest = None
             else:
-                self.diag.info("No tests available for reuse : " + test.uniqueName)
+                newTest = self.takeTestForReuse(test, state, tryReuse)
+            if newTest is None and tryReuse and self.getSlaveIdleTimeout(test) > 0:
+                newTest = self.waitForTestForReuse(test, state)
+            if newTest:
+                if not doneRerun:
+                    self.reusedTests[test] = newTest
+                self.jobs[newTest] = self.getJobInfo(test)
+                return newTest
             self.reusedTests[test] = None
                     
         # Allowed a submitted job to terminate
@@ -241,6 +338,79 @@ class QueueSystemServer(BaseActionRunner):
                 self.diag.info("Forcing termination")
                 self.submitTerminators()
             
+    def adaptCapacity(self, test):
+        # Returns True if we have more slaves than we now want
+        queueSystem = self.getQueueSystem(test)
+        if not queueSystem.hasAdaptiveCapacity():
+            return False
+        queueCapacity = queueSystem.getCapacity()
+        with self.counterLock:
+            if queueCapacity != self.maxCapacity:
+                self.diag.info("Changing capacity from " + str(self.maxCapacity) + " to " + str(queueCapacity))
+            grown = queueCapacity > self.maxCapacity
+            self.maxCapacity = queueCapacity
+            if grown and self.reuseOnly and self.testCount > 0 and self.testsSubmitted < self.maxCapacity:
+                # Wake up the submission thread, it's waiting for reuse failures
+                self.reuseFailureQueue.put(self.capacityGrown)
+            return self.testsSubmitted > self.maxCapacity
+
+    def takeTestForReuse(self, test, state, tryReuse):
+        # Don't allow this to use up the terminator
+        newTest = self.getTest(block=False, replaceTerminators=True)
+        if newTest:
+            if tryReuse and self.allowReuse(test, state, newTest):
+                with self.counterLock:
+                    if self.testCount > 1:
+                        self.testCount -= 1
+                        postText = self.remainStr()
+                    else:
+                        # Don't allow test count to drop to 0 here, can cause race conditions
+                        self.submitTerminators() 
+                        postText = ": submitting terminators as final test"
+                self.diag.info("Reusing slave from " + test.uniqueName + " for " + newTest.uniqueName + postText)
+                return newTest
+            else:
+                self.diag.info("Adding to reuse failure queue : " + newTest.uniqueName)
+                self.reuseFailureQueue.put(newTest)
+        else:
+            self.diag.info("No tests available for reuse : " + test.uniqueName)
+
+    def getSlaveIdleTimeout(self, test):
+        # Remote slaves give up on a reply after 25 seconds, in case of firewalls, so don't keep them waiting that long
+        if self.getQueueSystem(test).slavesOnRemoteSystem():
+            return min(self.slaveIdleTimeout, 20)
+        else:
+            return self.slaveIdleTimeout
+
+    def waitForTestForReuse(self, test, state):
+        # Keep the slave alive for a while, in case a test it can run turns up.
+        # Saves submitting a new job and the new slave reading all the tests again
+        self.diag.info("Slave from " + test.uniqueName + " waiting for a test it can run")
+        handoff = Queue()
+        endTime = time.time() + self.getSlaveIdleTimeout(test)
+        while not self.exited and not self.allComplete:
+            with self.idleLock:
+                self.idleSlaves[test] = state, handoff
+            try:
+                return handoff.get(timeout=max(min(endTime - time.time(), 1), 0))
+            except Empty:
+                with self.idleLock:
+                    self.idleSlaves.pop(test, None)
+                # It might have arrived just before we removed ourselves
+                newTest = self.getItemFromQueue(handoff, block=False) or self.takeTestForReuse(test, state, True)
+                if newTest or time.time() >= endTime:
+                    return newTest
+
+    def handOffToIdleSlave(self, test):
+        with self.idleLock:
+            for oldTest, (oldState, handoff) in self.idleSlaves.items():
+                if self.allowReuse(oldTest, oldState, test):
+                    self.diag.info("Handing " + test.uniqueName + " to idle slave from " + oldTest.uniqueName)
+                    del self.idleSlaves[oldTest]
+                    handoff.put(test)
+                    return True
+        return False
+
     def allowReuse(self, oldTest, oldState, newTest):
         # Don't reuse jobs that have been killed
         if newTest.state.isComplete() or oldState.category == "killed":
@@ -295,9 +465,16 @@ class QueueSystemServer(BaseActionRunner):
             sock.sendall("SUT_SERVER:" + state + "\n")
             sock.close()
             
+    def getReuseFailure(self, block):
+        # Capacity changes don't matter here, we're looking for tests anyway
+        while True:
+            reuseFailure = self.getItemFromQueue(self.reuseFailureQueue, block=block)
+            if reuseFailure is not self.capacityGrown:
+                return reuseFailure
+
     def getTestForRunNormalMode(self, block):
         self.reuseOnly = False
-        reuseFailure = self.getItemFromQueue(self.reuseFailureQueue, block=False)
+        reuseFailure = self.getReuseFailure(block=False)
         if reuseFailure:
             self.diag.info("Found a reuse failure...")
             return reuseFailure
@@ -309,12 +486,17 @@ class QueueSystemServer(BaseActionRunner):
             else:
                 # Make sure we pick up anything that failed in reuse while we were submitting the final test...
                 self.diag.info("No normal test found, checking reuse failures...")
-                return self.getItemFromQueue(self.reuseFailureQueue, block=False)
+                return self.getReuseFailure(block=False)
             
     def getTestForRunReuseOnlyMode(self, block):
         self.reuseOnly = True
         self.diag.info("Waiting for reuse failures...")
         reuseFailure = self.getItemFromQueue(self.reuseFailureQueue, block=block)
+        while reuseFailure is self.capacityGrown:
+            if self.testCount > 0 and self.testsSubmitted < self.maxCapacity:
+                return self.getTestForRunNormalMode(block)
+            # Used up by another slave in the meantime, carry on waiting
+            reuseFailure = self.getItemFromQueue(self.reuseFailureQueue, block=block)
         if reuseFailure:
             return reuseFailure
         elif self.testCount > 0 and self.testsSubmitted < self.maxCapacity:
@@ -334,7 +516,14 @@ class QueueSystemServer(BaseActionRunner):
 
     def notifyAllComplete(self):
         BaseActionRunner.notifyAllComplete(self)
+        self.pollWakeup.wake()
+        self.waitForFileFetches()
         self.cleanup(final=True)
+        RemoteCopyManager.getInstance().logStatistics()
+        if self.optionMap.has_key("submaster"):
+            return # The coordinating master records durations and reports errors from all the slaves
+        for expectedDurations in self.expectedDurations.values():
+            expectedDurations.write()
         errors = {}
         errorFiles = []
         for logDir in self.slaveLogDirs:
@@ -416,7 +605,28 @@ class QueueSystemServer(BaseActionRunner):
                  self.getSlaveArgs(test) + self.getRunOptions(test.app, submissionRules)
 
     def getSlaveArgs(self, test):
-        return [ "-slave", test.app.writeDirectory, "-servaddr", self.submitAddress ]
+        args = [ "-slave", test.app.writeDirectory, "-servaddr", self.submitAddress ]
+        snapshotFile = self.getApplicationSnapshot(test)
+        if snapshotFile:
+            args += [ "-warmstart", snapshotFile ]
+        return args
+
+    def getApplicationSnapshot(self, test):
+        # All the application's tests have been read by the time the first is submitted
+        app = test.app
+        if not app.recordsTestTree() or self.getQueueSystem(test).slavesOnRemoteSystem():
+            return
+        with self.snapshotLock:
+            if app not in self.snapshotFiles:
+                fileName = os.path.join(self.getSlaveLogDir(test), "snapshot." + app.name + app.versionSuffix())
+                try:
+                    testmodel.ApplicationSnapshot(app).write(fileName)
+                    self.diag.info("Wrote application snapshot for slaves to " + fileName)
+                    self.snapshotFiles[app] = fileName
+                except (IOError, OSError, PicklingError), e:
+                    plugins.printWarning("Could not write snapshot of " + app.description() + " for slaves, they will read everything themselves: " + str(e))
+                    self.snapshotFiles[app] = None
+            return self.snapshotFiles[app]
     
     def getRunOptions(self, app, submissionRules):
         runOptions = []
@@ -457,6 +667,69 @@ class QueueSystemServer(BaseActionRunner):
             if remoteMachine:
                 return remoteMachine, test.writeDirectory
         
+    def sentDifferencesOnly(self, test, state):
+        # Should match what the slave decides in SocketResponder.getSandboxPathsToSend
+        return test.getConfigValue("queue_system_result_transfer") == "differences" and \
+               not self.optionMap.has_key("keepslave") and not self.optionMap.has_key("keeptmp") and \
+               state.hasResults() and not state.hasSucceeded()
+
+    def fetchRemainingFiles(self, test, state):
+        # The slave left the rest of its sandbox behind. Fetch it in the background, before the machine is released
+        if not self.sentDifferencesOnly(test, state) or test in self.fileFetchEvents:
+            return
+        remoteTmpDir = self.getRemoteTestTmpDir(test)
+        if remoteTmpDir:
+            jobId = self.getJobInfo(test)[-1][0]
+            self.getQueueSystem(test).setFilesPending(jobId, True)
+            with self.fileFetchLock:
+                self.fileFetchEvents[test] = Event()
+                if self.fileFetchThread is None:
+                    self.fileFetchThread = Thread(target=self.runFileFetches, name="FileFetcher")
+                    self.fileFetchThread.setDaemon(True)
+                    self.fileFetchThread.start()
+            self.fileFetchQueue.put((test, jobId) + remoteTmpDir)
+
+    def runFileFetches(self):
+        while True:
+            test, jobId, machine, writeDir = self.fileFetchQueue.get()
+            if test is None:
+                return
+            try:
+                self.fetchFiles(test, machine, writeDir)
+            finally:
+                self.getQueueSystem(test).setFilesPending(jobId, False)
+                self.fileFetchEvents[test].set()
+
+    def fetchFiles(self, test, machine, writeDir):
+        self.notify("Status", "Fetching files for " + repr(test) + " from " + machine + " ...")
+        if test.app.copyFileRemotely(writeDir, machine, os.path.dirname(writeDir), "localhost") == 0:
+            self.notify("Status", "Fetched files for " + repr(test) + " from " + machine + ".")
+        else:
+            plugins.printWarning("Failed to fetch files for " + repr(test) + " from " + machine)
+        # Don't leave it there, the machine's disk is shared with other runs
+        test.app.runCommandOn(machine, [ "rm", "-rf", writeDir ])
+
+    def waitForFileFetches(self):
+        with self.fileFetchLock:
+            if self.fileFetchThread is None:
+                return
+            self.fileFetchQueue.put((None, None, None, None))
+        if self.fileFetchThread.isAlive():
+            self.notify("Status", "Waiting for files to be fetched from slave machines ...")
+            self.fileFetchThread.join()
+
+    def testFilesPending(self, test):
+        fetchEvent = self.fileFetchEvents.get(test)
+        return fetchEvent is not None and not fetchEvent.isSet()
+
+    def waitForTestFiles(self, test):
+        fetchEvent = self.fileFetchEvents.get(test)
+        if fetchEvent is not None and not fetchEvent.isSet():
+            fetchEvent.wait()
+            return True
+        else:
+            return False
+        
     def getSubmitCmdArgs(self, test, *args):
         queueSystem = self.getQueueSystem(test)
         return queueSystem.getSubmitCmdArgs(*args)
@@ -530,7 +803,7 @@ class QueueSystemServer(BaseActionRunner):
         queueCapacity = queueSystem.getCapacity()
         if queueCapacity:
             with self.counterLock:
-                if queueCapacity < self.maxCapacity:
+                if queueCapacity < self.maxCapacity or queueSystem.hasAdaptiveCapacity():
                     self.maxCapacity = queueCapacity
         
     def handleErrorState(self, test, previouslySubmitted=False):
@@ -613,6 +886,10 @@ class QueueSystemServer(BaseActionRunner):
         test.changeState(newState)
         self.handleLocalError(test, previouslySubmitted)
     
+    def notifyKillProcesses(self, *args):
+        BaseActionRunner.notifyKillProcesses(self, *args)
+        self.pollWakeup.wake()
+
     def killTests(self):
         # If we've been killed with some sort of limit signal, wait here until we know
         # all tests terminate. Otherwise we rely on them terminating naturally, and if they don't
@@ -732,6 +1009,111 @@ class QueueSystemServer(BaseActionRunner):
     def describeJob(self, test, jobId, *args):
         postText = self.getPostText(test, jobId)
         plugins.log.info("T: Cancelling " + repr(test) + " " + postText)
+
+
+class ShardCoordinator(QueueSystemServer):
+    """ For very large runs. Divides the tests between several sub-masters, ordinary master processes that
+    each submit their share to the queue system. They pass on the results to our slave server as if they were slaves. """
+    def __init__(self, optionMap, allApps):
+        QueueSystemServer.__init__(self, optionMap, allApps)
+        self.shardCount = max((app.getConfigValue("queue_system_master_shards") for app in allApps))
+        self.subMasters = []
+
+    def addTest(self, test):
+        # The sub-masters create directories and decide the order
+        BaseActionRunner.addTest(self, test)
+
+    def run(self):
+        tests = []
+        test = self.getTest(block=True)
+        while test:
+            tests.append(test)
+            test = self.getTest(block=True)
+        with self.lock:
+            if self.exited:
+                for test in tests:
+                    self.cancel(test)
+                return
+            for i, (app, shardTests) in enumerate(self.makeShards(tests)):
+                self.startSubMaster(i + 1, app, shardTests)
+
+        # The sub-masters have reported everything by the time they exit
+        for process, shardTests, errorsFile in self.subMasters:
+            process.wait()
+            self.diag.info("Sub-master with process ID " + str(process.pid) + " exited with code " + str(process.returncode))
+            for test in shardTests:
+                if not test.state.isComplete():
+                    freeText = "The master process running this test exited without reporting its result.\n" + \
+                               "Its output can be found at " + errorsFile
+                    test.changeState(plugins.Unrunnable(briefText="sub-master exited", freeText=freeText, lifecycleChange="complete"))
+        self.diag.info("All sub-masters have exited")
+
+    def makeShards(self, tests):
+        testsByApp = OrderedDict()
+        for test in tests:
+            testsByApp.setdefault(test.app, []).append(test)
+        shardCount = min(self.shardCount, len(tests))
+        shards = []
+        for app, appTests in testsByApp.items():
+            appShardCount = max(1, int(round(float(shardCount * len(appTests)) / len(tests))))
+            if self.orderByDuration:
+                # Deal them out, so each sub-master gets a similar share of the long tests
+                self.sortByExpectedDuration(appTests)
+                shards += [ (app, appTests[i::appShardCount]) for i in range(appShardCount) ]
+            else:
+                # Keep whole test suites together where we can
+                shardSize = (len(appTests) + appShardCount - 1) / appShardCount
+                shards += [ (app, appTests[i:i + shardSize]) for i in range(0, len(appTests), shardSize) ]
+        return shards
+
+    def startSubMaster(self, index, app, tests):
+        logDir = app.makeWriteDirectory("slavelogs")
+        name = "submaster" + str(index)
+        testListFile = os.path.join(logDir, name + ".tests")
+        with open(testListFile, "w") as f:
+            f.write("-tp appdata=" + app.name + app.versionSuffix() + "\n")
+            for test in tests:
+                f.write(test.getRelPath() + "\n")
+        cmdArgs = self.getSubMasterCommandArgs(app, testListFile)
+        errorsFile = os.path.join(logDir, name + ".errors")
+        plugins.log.info("Q: Starting sub-master " + str(index) + " for " + str(len(tests)) + " tests of " + app.description())
+        self.diag.info("Sub-master command arguments : " + repr(cmdArgs))
+        process = subprocess.Popen(cmdArgs, stdout=open(os.path.join(logDir, name + ".log"), "w"),
+                                   stderr=open(errorsFile, "w"), cwd=logDir, startupinfo=plugins.getHideStartUpInfo())
+        self.subMasters.append((process, tests, errorsFile))
+
+    def getSubMasterCommandArgs(self, app, testListFile):
+        args = [ sys.executable, plugins.getTextTestProgram(),
+                 "-d", ":".join(self.optionMap.rootDirectories),
+                 "-a", app.name + app.versionSuffix(),
+                 "-f", testListFile, "-submaster", app.writeDirectory, "-servaddr", self.submitAddress ]
+        for switch in app.getSubMasterSwitches():
+            if self.optionMap.has_key(switch):
+                args.append("-" + switch)
+                value = self.optionMap.get(switch)
+                if value:
+                    args.append(value)
+        return args
+
+    def getTestForReuse(self, *args):
+        pass # The sub-masters do this for their slaves
+
+    def setRemoteProcessId(self, *args):
+        pass
+
+    def killTests(self):
+        for process, _, _ in self.subMasters:
+            if process.poll() is None:
+                self.diag.info("Killing sub-master with process ID " + str(process.pid))
+                if os.name == "posix":
+                    process.send_signal(self.killSignal or signal.SIGTERM)
+                else:
+                    process.terminate()
+
+    def killOrCancel(self, test):
+        plugins.printWarning("Cannot kill individual tests when sharding between master processes, " +
+                             repr(test) + " will run to completion")
+
         
 # Used in slave
 class BasicSubmissionRules:
@@ -919,61 +1301,108 @@ class SlaveRequestHandler(StreamRequestHandler):
         if identifier == "TERMINATE_SERVER":
             return
 
-        self.handleMessage(identifier)
+        version = parseProtocolGreeting(identifier)
+        if version is None:
+            self.framed = False
+            self.handleMessage(identifier, self.rfile, self.rfile)
+            self.connection.shutdown(socket.SHUT_RDWR)
+        elif version == protocolVersion:
+            self.framed = True
+            self.handleFramedMessages()
+        else:
+            sys.stderr.write("WARNING: Received request from hostname " + self.getHostName(self.client_address[0]) +
+                             " using slave protocol version " + str(version) + ", expected " + str(protocolVersion) + "\n")
+
+    def handleFramedMessages(self):
+        # Persistent connection from a slave: keep going until it hangs up
+        try:
+            while True:
+                frameType, payload = readFrame(self.rfile)
+                if frameType is None:
+                    break
+                messageFile = StringIO(payload)
+                dataReader = FrameDataReader(self.rfile)
+                self.replied = False
+                self.handleMessage(messageFile.readline().strip(), messageFile, dataReader)
+                if not self.replied:
+                    self.writeReply("")
+        except (EOFError, socket.error), e:
+            # Slave went away, it will reconnect and resend if it's still there
+            self.server.diag.info("Lost connection to slave at " + repr(self.client_address) + " : " + str(e))
         
-    def handleMessage(self, identifier):
+    def handleMessage(self, identifier, messageFile, dataFile):
         # Don't use port, it changes all the time
         identifier, sendFiles, getFiles, tryReuse, rerun = parseIdentifier(identifier)
-        testString = self.rfile.readline().strip()
+        testString = messageFile.readline().strip()
         test = self.server.getTest(testString)    
         if test is None:
             clientHost = self.client_address[0]
             sys.stderr.write("WARNING: Received request from hostname " + self.getHostName(clientHost) +
                              " (process " + identifier + ")\nwhich could not be parsed:\n'" + testString + "'\n")
         elif getFiles:
-            self.pushFiles(test)
+            self.pushFiles(test, messageFile)
         elif not test.state.isComplete() or not test.state.hasResults(): # we might have killed it already...
             if sendFiles:
                 self.server.diag.info("Test " + test.uniqueName + " - receiving files sent from slave to sandbox directory")
-                directoryUnserialise(test.writeDirectory, self.rfile)
+                self.receiveFiles(test, dataFile)
             # Don't use port, it changes all the time
-            self.handleRequestFromHost(test, identifier, tryReuse, rerun)
+            self.handleRequestFromHost(test, identifier, tryReuse, rerun, messageFile)
         else:
             self.server.diag.info("Test " + test.uniqueName + " already complete, ignoring new results")
             self.sendReuseResponse(test, test.state, tryReuse, False)
-        self.connection.shutdown(socket.SHUT_RDWR)
+        if sendFiles and self.framed:
+            dataFile.skip() # anything not read, so we're ready for the next message
             
+    def receiveFiles(self, test, dataFile):
+        if not self.framed:
+            return directoryUnserialise(test.writeDirectory, dataFile)
+        try:
+            receiveDirectory(test.writeDirectory, dataFile)
+        except tarfile.TarError, e:
+            sys.stderr.write("WARNING: Failed to receive files for test " + test.uniqueName + " from slave : " + str(e) + "\n")
+
     def getHostName(self, ipAddress):
         try:
             return socket.gethostbyaddr(ipAddress)[0].split(".")[0]
         except socket.error:
             return ipAddress
         
-    def pushFiles(self, test):
-        userAndHost = self.rfile.readline().strip()
+    def pushFiles(self, test, messageFile):
+        userAndHost = messageFile.readline().strip()
         paths = []
-        for line in self.rfile:
+        for line in messageFile:
             paths.append(line.strip())
         self.server.pushFiles(test, userAndHost, paths)
+
+    def writeReply(self, text):
+        if self.framed:
+            self.wfile.write(makeFrame(replyFrame, text))
+            self.replied = True
+        elif text:
+            self.wfile.write(text)
         
     def sendReuseResponse(self, *args):
         newTest = QueueSystemServer.instance.getTestForReuse(*args)
         if newTest:
-            self.wfile.write(socketSerialise(newTest))
+            self.writeReply(socketSerialise(newTest))
 
-    def handleRequestFromHost(self, test, pid, tryReuse, rerun):
+    def handleRequestFromHost(self, test, pid, tryReuse, rerun, messageFile):
         # The updates are only for testing against old slave traffic,
         # a bit sad we can't disable them when not testing...
-        _, state = test.getNewState(self.rfile, updatePaths=True)
+        _, state = test.getNewState(messageFile, updatePaths=True)
         if test.state.isComplete():
             state.lifecycleChange = "recalculated"
         doneRerun = self.server.changeStateOrRerun(test, state, rerun)
-        try:
-            self.connection.shutdown(socket.SHUT_RD)
-        except socket.error:
-            # This only occurs on a mac, and doesn't affect functionality.
-            pass
+        if not self.framed:
+            try:
+                self.connection.shutdown(socket.SHUT_RD)
+            except socket.error:
+                # This only occurs on a mac, and doesn't affect functionality.
+                pass
         if state.isComplete():
+            if not doneRerun:
+                # Before the slave might terminate, so we still have the machine
+                QueueSystemServer.instance.fetchRemainingFiles(test, state)
             self.sendReuseResponse(test, state, tryReuse, doneRerun)
         else:
             QueueSystemServer.instance.setRemoteProcessId(test, pid)
@@ -983,13 +1412,15 @@ class SlaveServerResponder(plugins.Responder, ThreadingTCPServer):
     # Python's default value of 5 isn't very much...
     # There doesn't seem to be any disadvantage of allowing a longer queue, so we will use the system's maximum size
     request_queue_size = socket.SOMAXCONN    
+    # Slaves keep their connections open until they terminate, they shouldn't stop us exiting
+    daemon_threads = True
     def __init__(self, optionMap, allApps):
         plugins.Responder.__init__(self)
         ThreadingTCPServer.__init__(self, (getIPAddress(allApps), 0), self.handlerClass())
         self.testMap = {}
         self.testLocks = {}
         self.filePushLock = Lock()
-        self.filePushProcesses = {}
+        self.filePushEvents = {}
         self.diag = logging.getLogger("Slave Server")
         self.terminate = False
         self.totalReruns = 0
@@ -1095,30 +1526,40 @@ class SlaveServerResponder(plugins.Responder, ThreadingTCPServer):
         except ValueError:
             return
         
-    def getFilePushProcess(self, test, userAndHost, path):
+    def getFilePushEvent(self, userAndHost, path):
         key = userAndHost, path
         with self.filePushLock:
-            if key in self.filePushProcesses:
-                return self.filePushProcesses[key], False
-            else:   
-                proc = test.app.getRemoteCopyFileProcess(path, "localhost", os.path.dirname(path), userAndHost)
-                self.filePushProcesses[key] = proc
-                return proc, True
+            if key in self.filePushEvents:
+                return self.filePushEvents[key], False
+            else:
+                self.filePushEvents[key] = Event()
+                return self.filePushEvents[key], True
         
     def pushFiles(self, test, userAndHost, paths):
+        # Push everything nobody has asked for before at the same time, then wait for anything others are pushing
+        toPush, toWait = [], []
         for path in paths:
-            proc, started = self.getFilePushProcess(test, userAndHost, path)
+            doneEvent, started = self.getFilePushEvent(userAndHost, path)
             if started:
-                self.diag.info("Pushing '" + path + "'...")
-                proc.wait()
-                self.diag.info("Done Pushing '" + path + "'")
+                toPush.append((path, doneEvent))
+            else:
+                toWait.append((path, doneEvent))
+        if toPush:
+            pushPaths = [ path for path, _ in toPush ]
+            self.diag.info("Pushing " + repr(pushPaths) + "...")
+            try:
+                test.app.copyFilesRemotely([ (path, "localhost", os.path.dirname(path), userAndHost) for path in pushPaths ])
+            finally:
+                for _, doneEvent in toPush:
+                    doneEvent.set()
+            self.diag.info("Done Pushing " + repr(pushPaths))
+            for path in pushPaths:
                 # Aim for synchronising tests properly
                 QueueSystemServer.instance.sendServerState("Sychronised " + path + " to " + userAndHost)
-            else:
-                self.diag.info("Waiting for '" + path + "'...")
-                while proc.poll() is None:
-                    time.sleep(0.1)
-                self.diag.info("Done Waiting for '" + path + "'.")
+        for path, doneEvent in toWait:
+            self.diag.info("Waiting for '" + path + "'...")
+            doneEvent.wait()
+            self.diag.info("Done Waiting for '" + path + "'.")
 
 
 class MasterTextResponder(TextDisplayResponder):
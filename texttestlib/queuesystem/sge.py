@@ -2,7 +2,8 @@
 import os, string, subprocess
 import gridqueuesystem
 from texttestlib.plugins import gethostname, log, TextTestError
-from time import sleep
+from texttestlib.utils import getUserName
+from time import sleep, time, strftime, localtime
 
 # Used by master process for submitting, deleting and monitoring slave jobs
 class QueueSystem(gridqueuesystem.QueueSystem):
@@ -29,6 +30,8 @@ class QueueSystem(gridqueuesystem.QueueSystem):
     def __init__(self, *args):
         self.qdelOutput = ""
         self.errorReasons = {}
+        self.accountInfo = {}
+        self.submitTimes = {}
         gridqueuesystem.QueueSystem.__init__(self, *args)
         
     def getSlaveStartErrorFile(self):
@@ -94,21 +97,24 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         for line in stdout.splitlines():
             if line.find("has been submitted") != -1:
                 jobId = self.getJobId(line)
+                self.submitTimes[jobId] = time()
             else:
                 log.info("Unexpected output from qsub : " + line.strip())
         return jobId
 
-    def getStatusForAllJobs(self):
-        statusDict = {}
+    def getStatusOutput(self):
         proc = subprocess.Popen([ "qstat" ], stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         outMsg = proc.communicate()[0]
-        if proc.returncode > 0:
-            # SGE unavailable for the moment, don't update the job status
-            return
-        
+        if proc.returncode == 0:
+            return outMsg
+        # Otherwise SGE is unavailable for the moment, don't update the job status
+
+    def parseStatusOutput(self, outMsg, jobIds):
+        statusDict = {}
         for line in outMsg.splitlines():
             words = line.split()
-            if len(words) >= 5 and words[0].isdigit():
+            # Output may be shared with other masters, leave their jobs alone
+            if len(words) >= 5 and words[0] in jobIds:
                 jobId = words[0]
                 statusLetter = self.getStatusLetter(words, 4)
                 if statusLetter in self.errorStatuses:
@@ -163,7 +169,14 @@ class QueueSystem(gridqueuesystem.QueueSystem):
     def _getJobFailureInfo(self, jobId):
         if jobId in self.errorReasons: 
             return "SGE job entered error state: " + jobId + "\nTextTest terminated this job as a result. SGE's error reason follows:\n" + self.errorReasons.get(jobId)
-        methods = [ self.getAccountInfo, self.getAccountInfoOldFiles, self.retryAccountInfo ]
+        if jobId in self.accountInfo:
+            acctOutput = self.accountInfo[jobId]
+            if acctOutput is not None:
+                return acctOutput
+            # Already waited for it along with the others, no point waiting again
+            methods = [ self.getAccountInfoOldFiles ]
+        else:
+            methods = [ self.getAccountInfo, self.getAccountInfoOldFiles, self.retryAccountInfo ]
         acctError = ""
         for method in methods:
             acctOutput, acctError = method(jobId)
@@ -184,6 +197,51 @@ class QueueSystem(gridqueuesystem.QueueSystem):
         else:
             return None, errMsg
 
+    def prefetchJobFailureInfo(self, jobIds):
+        # One qacct call for all of our jobs that finished recently, instead of several per job.
+        # Retry all the missing ones together, in case they haven't propagated yet
+        jobIds = [ jobId for jobId in jobIds if jobId not in self.errorReasons and jobId not in self.accountInfo ]
+        if not jobIds:
+            return
+        sleepTime = 0.5
+        found = {}
+        for attempt in range(10):
+            if attempt:
+                log.info("Waiting " + str(sleepTime) + " seconds before retrying account info for " + str(len(jobIds) - len(found)) + " jobs")
+                sleep(sleepTime)
+                if sleepTime < 5:
+                    sleepTime *= 2
+            found.update(self.getRecentAccountInfo(jobIds))
+            if len(found) == len(jobIds):
+                break
+        for jobId in jobIds:
+            self.accountInfo[jobId] = found.get(jobId)
+
+    def getRecentAccountInfo(self, jobIds):
+        cmdArgs = [ "qacct", "-o", getUserName() ] + self.getStartTimeArgs(jobIds) + [ "-j" ]
+        proc = subprocess.Popen(cmdArgs, stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        outMsg = proc.communicate()[0]
+        accountInfo = {}
+        record = []
+        # Each record starts with a line of "=" signs
+        for line in outMsg.splitlines(True) + [ "=" ]:
+            if line.startswith("=") and record:
+                for recordLine in record:
+                    words = recordLine.split()
+                    if len(words) == 2 and words[0] == "jobnumber" and words[1] in jobIds:
+                        accountInfo[words[1]] = "".join(record)
+                record = []
+            record.append(line)
+        return accountInfo
+
+    def getStartTimeArgs(self, jobIds):
+        # Only look through jobs that started since we submitted the earliest of these,
+        # allowing a few minutes for the clocks on different machines not quite agreeing
+        submitTimes = [ self.submitTimes.get(jobId) for jobId in jobIds ]
+        if None in submitTimes:
+            return [ "-d", "1" ]
+        return [ "-b", strftime("%Y%m%d%H%M", localtime(min(submitTimes) - 300)) ]
+
     def retryAccountInfo(self, jobId):
         sleepTime = 0.5
         acctError = ""
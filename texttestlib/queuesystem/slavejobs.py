@@ -4,6 +4,7 @@ Module containing code that's only run in the slave jobs when running with a gri
 """
 
 import os, sys, time, socket, signal, logging
+from threading import Lock
 from utils import *
 from texttestlib import plugins
 from texttestlib.default.runtest import RunTest
@@ -57,15 +58,35 @@ class RedirectLogResponder(plugins.Responder):
                 plugins.log.addHandler(handler)
 
 
+class ConnectionFailed(Exception):
+    pass
+
+
 class SocketResponder(plugins.Responder,plugins.Observable):
     synchFiles = False
-    def __init__(self, optionMap, *args):
+    # Local masters can be slow to reply when very busy, but shouldn't take this long
+    localReplyTimeout = 300
+    def __init__(self, optionMap, allApps, *args):
         plugins.Responder.__init__(self)
         plugins.Observable.__init__(self)
         self.killed = False
         self.transferAll = optionMap.get("keepslave") or optionMap.get("keeptmp")
         self.testsForRerun = []
         self.serverAddress = self.getServerAddress(optionMap)
+        # Traffic recorded for self-testing expects one connection per message
+        self.persistent = "CAPTUREMOCK_SERVER" not in os.environ
+        self.connection = None
+        self.connectionLock = Lock()
+        self.replyTimeout = self.getReplyTimeout(allApps)
+
+    def getReplyTimeout(self, allApps):
+        if self.synchFiles:
+            # See sendData
+            return 25
+        else:
+            # The master may keep us waiting for a new test this long before replying
+            idleTimeout = max([ app.getConfigValue("queue_system_slave_idle_timeout") for app in allApps ] + [ 0 ])
+            return idleTimeout + self.localReplyTimeout
     
     def getServerAddress(self, optionMap):
         servAddrStr = optionMap.get("servaddr", os.getenv("CAPTUREMOCK_SERVER"))
@@ -106,22 +127,48 @@ class SocketResponder(plugins.Responder,plugins.Observable):
         testData = socketSerialise(test)
         pickleData = dumps(state)
         sendFiles = self.synchFiles and changeDesc == "complete" and (self.transferAll or not test.state.hasSucceeded())
-        fullData = self.getProcessIdentifier(test, sendFiles) + os.linesep + testData + os.linesep
-        if sendFiles:
-            fullData += directorySerialise(test.writeDirectory) + os.linesep
-        fullData += pickleData
-        return self.sendAndInterpret(fullData, self.interpretResponse, state)
+        header = self.getProcessIdentifier(test, sendFiles) + os.linesep + testData + os.linesep
+        sandboxFiles = (test.writeDirectory, self.getSandboxPathsToSend(test, state)) if sendFiles else None
+        if self.persistent:
+            fullData = makeFrame(messageFrame, header + pickleData)
+        elif sendFiles:
+            fullData = header + directorySerialise(test.writeDirectory) + os.linesep + pickleData
+        else:
+            fullData = header + pickleData
+        return self.sendAndInterpret(fullData, sandboxFiles, self.interpretResponse, state)
+
+    def getSandboxPathsToSend(self, test, state):
+        # None means everything
+        if self.transferAll or not state.hasResults() or \
+               test.getConfigValue("queue_system_result_transfer") != "differences":
+            return
+        # Just what's needed to view and approve the differences. The rest stays here, the master can fetch it if needed
+        fullPaths = [ test.makeTmpFileName("file_edits", forComparison=0) ]
+        for comparison in state.getComparisons():
+            fullPaths += [ comparison.tmpFile, comparison.tmpCmpFile ]
+        paths = []
+        for path in fullPaths:
+            relPath = plugins.relpath(path, test.writeDirectory) if path and os.path.exists(path) else None
+            if relPath and relPath not in paths:
+                paths.append(relPath)
+        return paths
         
-    def sendAndInterpret(self, fullData, responseMethod, *args):
+    def sendAndInterpret(self, fullData, sandboxFiles, responseMethod, *args):
         sleepTime = 1
         for _ in range(9):
-            sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            if not self.connect(sendSocket):
-                return self.notify("NoMoreExtraTests")
             try:
-                response = self.sendData(sendSocket, fullData)
+                if self.persistent:
+                    response = self.sendFramedData(fullData, sandboxFiles)
+                else:
+                    sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    if not self.connect(sendSocket):
+                        return self.notify("NoMoreExtraTests")
+                    response = self.sendData(sendSocket, fullData)
                 return responseMethod(response, *args) if responseMethod else True
-            except socket.error, e:
+            except ConnectionFailed:
+                return self.notify("NoMoreExtraTests")
+            except (socket.error, EOFError), e:
+                self.closeConnection()
                 plugins.log.info("Failed to communicate with master process - waiting " +
                                  str(sleepTime) + " seconds and then trying again.")
                 plugins.log.info("Error received was " + str(e))
@@ -144,6 +191,52 @@ class SocketResponder(plugins.Responder,plugins.Observable):
         sendSocket.close()
         return response
 
+    def sendFramedData(self, fullData, sandboxFiles):
+        with self.connectionLock:
+            if self.connection is None:
+                self.openConnection()
+            sendSocket, readFile = self.connection
+            try:
+                sendSocket.sendall(fullData)
+                if sandboxFiles:
+                    # Straight from disk to the socket, a chunk at a time
+                    sandbox, paths = sandboxFiles
+                    sendDirectory(sandbox, FrameDataWriter(sendSocket.sendall, compress=True), paths)
+                frameType, response = readFrame(readFile)
+            except:
+                # Whatever went wrong, the reply (if any) is still unread, so the connection can't be reused
+                self.closeConnection()
+                raise
+            if frameType != replyFrame:
+                raise EOFError, "Master process closed the connection"
+            return response
+
+    def openConnection(self):
+        sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if not self.connect(sendSocket):
+            raise ConnectionFailed
+        # The connection is idle while tests run. Firewalls and NAT may drop it silently in the meantime,
+        # so make sure we find out, rather than waiting for a reply forever. A timeout makes us reconnect and retry
+        self.enableKeepAlive(sendSocket)
+        sendSocket.settimeout(self.replyTimeout)
+        sendSocket.sendall(makeProtocolGreeting() + "\n")
+        self.connection = sendSocket, sendSocket.makefile("rb")
+
+    @staticmethod
+    def enableKeepAlive(sendSocket):
+        sendSocket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # By default the first probe is only sent after two hours. Not all platforms let us change that
+        for option, value in [ ("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15), ("TCP_KEEPCNT", 4) ]:
+            if hasattr(socket, option):
+                sendSocket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def closeConnection(self):
+        if self.connection is not None:
+            sendSocket, readFile = self.connection
+            readFile.close()
+            sendSocket.close()
+            self.connection = None
+
     def interpretResponse(self, response, state):
         if len(response) > 0:
             appDesc, testPath = socketParse(response)
@@ -158,9 +251,20 @@ class SocketResponder(plugins.Responder,plugins.Observable):
                 plugins.log.info(test.getIndent() + "Fetching required test data at " + repr(path) + " ...")
             data = makeIdentifierLine(str(os.getpid()), getFiles=True) + "\n" + socketSerialise(test) + "\n" + \
                 getUserName() + "@" + getIPAddress([ test ]) + "\n" + "\n".join(paths)
-            self.sendAndInterpret(data, None) # Just wait, no response to interpret
+            if self.persistent:
+                data = makeFrame(messageFrame, data)
+            self.sendAndInterpret(data, None, None) # Just wait, no response to interpret
             
 
+class SubMasterResponder(SocketResponder):
+    """ Passes on our test results to the coordinating master, when we run some of its tests """
+    def notifyRerun(self, test):
+        pass # Reruns are our business, the coordinating master only needs the final result
+
+    def interpretResponse(self, *args):
+        pass # It never gives us more tests
+
+
 class SlaveActionRunner(ActionRunner):
     def notifyAllRead(self, goodSuites):
         # don't ordinarily add a terminator, we might get given more tests via the socket (code above)
@@ -3,7 +3,7 @@
 Utilities for both master and slave code
 """
 
-import os, socket
+import os, socket, struct, zlib, tarfile
 from texttestlib import plugins
 
 noReusePostfix = ".NO_REUSE"
@@ -70,25 +70,174 @@ def parseIdentifier(line):
 
     return line, sendFiles, getFiles, tryReuse, rerun
 
+# Slaves that keep their connection open send this first, and then everything in both directions is framed:
+# a one-character frame type, the payload length as 4 bytes big-endian, then the payload.
+# Each message frame gets exactly one reply frame back, once any data frames following it have been read.
+protocolName = "TEXTTEST_SLAVE_PROTOCOL"
+protocolVersion = 1
+messageFrame, dataFrame, compressedDataFrame, endDataFrame, replyFrame = "M", "D", "Z", "E", "R"
+frameHeader = struct.Struct(">cI")
+dataChunkSize = 65536
+
+def makeProtocolGreeting():
+    return protocolName + " " + str(protocolVersion)
+
+def parseProtocolGreeting(line):
+    if line.startswith(protocolName + " "):
+        return int(line.split()[-1])
+
+def readExactly(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError, "Connection closed in the middle of a frame"
+    return data
+
+def readFrame(f):
+    header = f.read(frameHeader.size)
+    if not header:
+        return None, None # connection closed between frames, the normal way to finish
+    if len(header) < frameHeader.size:
+        raise EOFError, "Connection closed in the middle of a frame"
+    frameType, length = frameHeader.unpack(header)
+    return frameType, readExactly(f, length)
+
+def makeFrame(frameType, payload=""):
+    return frameHeader.pack(frameType, len(payload)) + payload
+
+def makeDataFrame(chunk, compress):
+    if compress:
+        compressed = zlib.compress(chunk)
+        if len(compressed) < len(chunk):
+            return makeFrame(compressedDataFrame, compressed)
+    return makeFrame(dataFrame, chunk)
+
+
+class FrameDataWriter:
+    """ File-like object sending what's written to it as data frames, a chunk at a time """
+    def __init__(self, sendMethod, compress=False):
+        self.sendMethod = sendMethod
+        self.compress = compress
+        self.buffer = []
+        self.bufferSize = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.bufferSize += len(data)
+        if self.bufferSize >= dataChunkSize:
+            data = "".join(self.buffer)
+            pos = 0
+            while len(data) - pos >= dataChunkSize:
+                self.sendMethod(makeDataFrame(data[pos:pos + dataChunkSize], self.compress))
+                pos += dataChunkSize
+            self.buffer = [ data[pos:] ]
+            self.bufferSize = len(self.buffer[0])
+
+    def close(self):
+        if self.bufferSize:
+            self.sendMethod(makeDataFrame("".join(self.buffer), self.compress))
+            self.buffer = []
+            self.bufferSize = 0
+        self.sendMethod(makeFrame(endDataFrame))
+
+
+class FrameDataReader:
+    """ File-like access to the data frames following a message """
+    def __init__(self, f):
+        self.f = f
+        self.finished = False
+        self.buffer = ""
+
+    def readChunk(self):
+        frameType, payload = readFrame(self.f)
+        if frameType == dataFrame:
+            return payload
+        elif frameType == compressedDataFrame:
+            return zlib.decompress(payload)
+        elif frameType == endDataFrame:
+            self.finished = True
+            return ""
+        else:
+            raise EOFError, "Expected data frame, got " + repr(frameType)
+
+    def read(self, size=-1):
+        chunks = [ self.buffer ]
+        available = len(self.buffer)
+        while not self.finished and (size < 0 or available < size):
+            chunk = self.readChunk()
+            chunks.append(chunk)
+            available += len(chunk)
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def skip(self):
+        while not self.finished:
+            self.readChunk()
+        self.buffer = ""
+
+
+def sendDirectory(dirName, f, paths=None):
+    # Stream the sandbox as a tar file, which keeps binary files intact along with permissions and modification times
+    # If paths are given (relative to the sandbox), send only those
+    tar = tarfile.open(fileobj=f, mode="w|")
+    try:
+        # Symbolic links are to the test data, which should already be there.
+        # Hard links are just how tar records the second name of a file the test wrote under two names, so keep those
+        linkFilter = lambda info: None if info.issym() else info
+        if paths is None:
+            tar.add(dirName, arcname=".", filter=linkFilter)
+        else:
+            for path in paths:
+                fullPath = os.path.join(dirName, path)
+                # Tests may remove files between being checked and being sent, they just don't need sending any more
+                if os.path.lexists(fullPath):
+                    tar.add(fullPath, arcname=path, filter=linkFilter)
+    finally:
+        tar.close()
+        f.close()
+
+def checkInside(rootDir, name):
+    path = os.path.normpath(os.path.join(rootDir, name))
+    if path != rootDir and not path.startswith(os.path.join(rootDir, "")):
+        raise tarfile.TarError, "Refusing to write " + repr(name) + " outside the sandbox"
+
+def receiveDirectory(rootDir, f):
+    rootDir = os.path.normpath(rootDir)
+    tar = tarfile.open(fileobj=f, mode="r|")
+    try:
+        for info in tar:
+            checkInside(rootDir, info.name)
+            if info.islnk():
+                checkInside(rootDir, info.linkname)
+            tar.extract(info, rootDir)
+    finally:
+        tar.close()
+
+
 dirText = "DIRECTORY_CONTENTS"
 fileText = "FILE_CONTENTS"
 endPrefix = "END_"
 
+# Text format for slaves that connect once per message, see sendDirectory for the others
 def directorySerialise(dirName, ignoreLinks=False):
-    text = ""
+    parts = []
     for root, _, files in os.walk(dirName):
         for fn in sorted(files):
             path = os.path.join(root, fn)
             if not os.path.islink(path):
                 relpath = plugins.relpath(path, dirName)
-                text += fileText + " " + relpath + "\n"
+                parts.append(fileText + " " + relpath + "\n")
                 with open(path) as f:
-                    text += f.read()
-                if not text.endswith("\n"):
-                    text += "\n"
-                text += endPrefix + fileText + "\n"
-    text += endPrefix + dirText
-    return text
+                    contents = f.read()
+                parts.append(contents)
+                if contents and not contents.endswith("\n"):
+                    parts.append("\n")
+                parts.append(endPrefix + fileText + "\n")
+    parts.append(endPrefix + dirText)
+    return "".join(parts)
 
 def directoryUnserialise(rootDir, f):
     currFile = None
@@ -0,0 +1,159 @@
+"""
+Module for running tests in parallel in worker threads of the master process, as an alternative to
+submitting TextTest slave processes to the local queue system
+"""
+
+import logging
+from threading import Thread, RLock
+from multiprocessing import cpu_count
+from ordereddict import OrderedDict
+from texttestlib import plugins
+from texttestlib.default.actionrunner import ActionRunner, ApplicationRunner, TestRunner
+
+class Worker:
+    def __init__(self, appRunners):
+        self.appRunners = appRunners
+        self.previousTestRunner = None
+        self.finished = False
+
+
+class SharedApplicationRunner(ApplicationRunner):
+    # Sets up the application and the suites once, for all the workers
+    def __init__(self, *args):
+        ApplicationRunner.__init__(self, *args)
+        self.suiteLock = RLock() # setUpSuites calls itself for the parent suites
+        self.suiteUsers = {}
+
+    def markForSetUp(self, suite):
+        with self.suiteLock:
+            users = self.suiteUsers.get(suite, 0)
+            if users == 0:
+                ApplicationRunner.markForSetUp(self, suite)
+            self.suiteUsers[suite] = users + 1
+
+    def setUpSuites(self, action, test):
+        # Other workers wait here until the suites are set up for them too
+        with self.suiteLock:
+            ApplicationRunner.setUpSuites(self, action, test)
+
+    def tearDownSuite(self, suite):
+        with self.suiteLock:
+            self.suiteUsers[suite] -= 1
+            if self.suiteUsers[suite] == 0:
+                ApplicationRunner.tearDownSuite(self, suite)
+
+
+class WorkerApplicationRunner:
+    # Each worker has its own copies of the actions, as they store information about the test they are running
+    def __init__(self, sharedRunner):
+        self.sharedRunner = sharedRunner
+        self.actionSequence = []
+        copies = {}
+        for action in sharedRunner.actionSequence:
+            if action not in copies: # the same action can appear more than once
+                copies[action] = action.makeParallelCopy()
+            self.actionSequence.append(copies[action])
+        self.originalActions = dict(((actionCopy, action) for action, actionCopy in copies.items()))
+
+    def markForSetUp(self, suite):
+        self.sharedRunner.markForSetUp(suite)
+
+    def setUpSuites(self, action, test):
+        self.sharedRunner.setUpSuites(self.originalActions[action], test)
+
+    def tearDownSuite(self, suite):
+        self.sharedRunner.tearDownSuite(suite)
+
+    def cleanActions(self):
+        self.actionSequence = []
+
+
+class WorkerThreadActionRunner(ActionRunner):
+    def __init__(self, optionMap, allApps):
+        ActionRunner.__init__(self, optionMap, allApps)
+        maxCapacity = min((app.getConfigValue("queue_system_max_capacity") for app in allApps))
+        self.workerCount = max(1, min(maxCapacity, cpu_count()))
+        self.workers = []
+        self.currentTestRunners = {}
+        self.workerWakeup = plugins.Wakeup()
+        self.workerDiag = logging.getLogger("Worker Threads")
+
+    def addSuite(self, suite):
+        plugins.log.info("Using " + suite.app.description(includeCheckout=True))
+        self.appRunners[suite.app] = SharedApplicationRunner(suite, self.diag)
+
+    def runAllTests(self):
+        self.workerDiag.info("Running tests in " + str(self.workerCount) + " worker threads")
+        for i in range(self.workerCount):
+            worker = Worker(self.makeAppRunners())
+            self.workers.append(worker)
+            thread = Thread(target=self.runWorker, args=(worker,), name="Worker" + str(i + 1))
+            thread.setDaemon(True)
+            thread.start()
+        # We're in the main thread, so wait in a way that lets signals be handled. thread.join doesn't.
+        while not all((worker.finished for worker in self.workers)):
+            self.workerWakeup.wait()
+        self.cleanup()
+        self.diag.info("Terminating")
+
+    def makeAppRunners(self):
+        appRunners = OrderedDict()
+        for app, appRunner in self.appRunners.items():
+            appRunners[app] = WorkerApplicationRunner(appRunner)
+        return appRunners
+
+    def runWorker(self, worker):
+        runMethod = lambda test: self.runTestInWorker(worker, test)
+        try:
+            self.runQueue(self.getTestForWorker, runMethod, "running")
+            self.workerDiag.info("No more tests, terminating worker")
+        finally:
+            worker.finished = True
+            self.workerWakeup.wake()
+
+    def getTestForWorker(self, block=True):
+        # Leave the terminator in the queue so the other workers find it too
+        return self.getItemFromQueue(self.testQueue, block, replaceTerminators=True)
+
+    def runTestInWorker(self, worker, test):
+        appRunner = worker.appRunners.get(test.app)
+        if appRunner:
+            self.lock.acquire()
+            testRunner = TestRunner(test, appRunner, self.diag, self.exited, self.killSignal)
+            self.currentTestRunners[test] = testRunner
+            self.lock.release()
+
+            self.workerDiag.info("Running " + repr(test))
+            testRunner.performActions(worker.previousTestRunner)
+            worker.previousTestRunner = testRunner
+
+            self.lock.acquire()
+            del self.currentTestRunners[test]
+            self.notifyComplete(test)
+            self.lock.release()
+
+    def notifyRerun(self, test):
+        self.lock.acquire()
+        testRunner = self.currentTestRunners.get(test)
+        if testRunner:
+            self.diag.info("Got rerun notification for " + repr(test) + ", resetting actions")
+            testRunner.resetActionSequence()
+        self.lock.release()
+
+    def killTests(self):
+        # Called with the lock held, see notifyKillProcesses
+        for testRunner in self.currentTestRunners.values():
+            testRunner.kill(self.killSignal)
+
+    def killOrCancel(self, test):
+        testRunner = self.currentTestRunners.get(test)
+        if testRunner:
+            testRunner.kill()
+        else:
+            self.cancel(test)
+
+    def cleanup(self):
+        ActionRunner.cleanup(self)
+        for worker in self.workers:
+            for appRunner in worker.appRunners.values():
+                appRunner.cleanActions()
@@ -3,7 +3,8 @@ import os, sys, types, string, plugins, exceptions, shutil, operator, logging, g
 from multiprocessing import cpu_count
 from ordereddict import OrderedDict
 from cPickle import Pickler, Unpickler, UnpicklingError
-from threading import Lock
+from threading import Lock, Thread
+from Queue import Queue, Empty
 from tempfile import mkstemp, mkdtemp
 from copy import deepcopy
 
@@ -13,27 +14,69 @@ defaults. To find information on the configurations provided with texttest, cons
 http://www.texttest.org
 """
 
-class DirectoryCache:
-    def __init__(self, dir):
+class DirectoryCache(object):
+    # Held by every test, so kept compact: the listing itself is only stored as the stem index,
+    # with file names and version sets shared between all the directories that contain them
+    __slots__ = ("dir", "index", "stems", "stemIndex", "sortedContents")
+    internedVersionSets = {}
+    def __init__(self, dir, index=None):
         self.dir = dir
-        self.contents = []
+        self.index = index
         self.refresh()
 
     def refresh(self):
         try:
-            self.contents = os.listdir(self.dir)
-            self.contents.sort()
+            if self.index:
+                contents = self.index.listdir(self.dir)
+            else:
+                contents = os.listdir(self.dir)
+                contents.sort()
         except OSError: # usually caused by people removing stuff externally
-            self.contents = []
+            contents = []
+        self.stems, self.stemIndex = self.makeStemIndex(contents)
+        self.sortedContents = None
+
+    def makeStemIndex(self, contents):
+        # stem -> [ (version set, file names) ], all in the order of the sorted directory listing
+        stems, stemIndex = [], {}
+        for fileName in contents:
+            if type(fileName) is str:
+                fileName = intern(fileName)
+            stem, versionSet = self.splitStem(fileName)
+            versionSets = stemIndex.get(stem)
+            if versionSets is None:
+                stems.append(stem)
+                versionSets = stemIndex[stem] = []
+            for currVersionSet, fileNames in versionSets:
+                if currVersionSet == versionSet:
+                    fileNames.append(fileName)
+                    break
+            else:
+                versionSets.append((self.internedVersionSets.setdefault(versionSet, versionSet), [ fileName ]))
+        return tuple(stems), stemIndex
+
+    @property
+    def contents(self):
+        # Only built for the few callers that need the full listing, but then usually wanted repeatedly
+        if self.sortedContents is None:
+            self.sortedContents = sorted(fileName for stem in self.stems for _, fileNames in self.stemIndex[stem] for fileName in fileNames)
+        return self.sortedContents
 
     def hasStem(self, stem):
-        for fileName in self.contents:
-            if fileName.startswith(stem):
-                return True
+        localStem = stem.split(".", 1)[0]
+        for _, fileNames in self.stemIndex.get(localStem, []):
+            for fileName in fileNames:
+                # Only whole name components, 'config.app' isn't there because of 'config.apple'
+                if fileName == stem or fileName.startswith(stem + "."):
+                    return True
         return False
 
     def exists(self, fileName):
-        return fileName in self.contents
+        stem, versionSet = self.splitStem(fileName)
+        for currVersionSet, fileNames in self.stemIndex.get(stem, []):
+            if currVersionSet == versionSet:
+                return fileName in fileNames
+        return False
 
     def pathName(self, fileName):
         return os.path.join(self.dir, fileName)
@@ -55,14 +98,20 @@ class DirectoryCache:
     def findVersionSets(self, stem, predicate):
         if "/" in stem:
             root, local = os.path.split(stem)
-            newCache = DirectoryCache(os.path.join(self.dir, root))
+            newCache = DirectoryCache(os.path.join(self.dir, root), self.index)
             return newCache.findVersionSets(local, predicate)
 
         versionSets = OrderedDict()
-        for fileName in self.contents:
-            versionSet = self.findVersionSet(fileName, stem)
-            if versionSet is not None and (predicate is None or predicate(versionSet)):
-                versionSets.setdefault(versionSet, []).append(self.pathName(fileName))
+        if "." in stem:
+            # Stems containing dots (e.g. data file names) don't match the index keys, scan instead
+            for fileName in self.contents:
+                versionSet = self.findVersionSet(fileName, stem)
+                if versionSet is not None and (predicate is None or predicate(versionSet)):
+                    versionSets.setdefault(versionSet, []).append(self.pathName(fileName))
+        else:
+            for versionSet, fileNames in self.stemIndex.get(stem, []):
+                if predicate is None or predicate(versionSet):
+                    versionSets[versionSet] = map(self.pathName, fileNames)
         return versionSets
 
     def findStemsMatching(self, pattern):
@@ -70,13 +119,324 @@ class DirectoryCache:
 
     def findAllStems(self, predicate=None):
         stems = []
-        for file in self.contents:
-            stem, versionSet = self.splitStem(file)
-            if len(stem) > 0 and stem not in stems and (predicate is None or predicate(stem, versionSet)):
+        for stem in self.stems:
+            if len(stem) > 0 and (predicate is None or any(predicate(stem, vset) for vset, _ in self.stemIndex[stem])):
                 stems.append(stem)
         return stems
 
 
+# Persistent record of directory listings and test suite file contents, so that
+# large test trees need only re-read the parts that have changed since the last run.
+# Entries are keyed on the mtime, inode and size of what they were read from.
+# Without a file name, it just holds what was read in parallel by prefetchTree, or in this run for others to use.
+class DirectoryIndex:
+    formatVersion = 1
+    instances = {}
+    @classmethod
+    def getInstance(cls, fileName):
+        if fileName not in cls.instances:
+            cls.instances[fileName] = cls(fileName)
+        return cls.instances[fileName]
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.dirEntries = {}
+        self.fileEntries = {}
+        # Paths read by prefetchTree, which are trusted without checking once, when first asked for
+        self.prefetched = {}
+        self.prefetchedRoots = set()
+        # Paths read in this run, as opposed to loaded from the file
+        self.readPaths = set()
+        self.changed = False
+        self.diag = logging.getLogger("test tree index")
+        self.load()
+
+    def load(self):
+        if not self.fileName or not os.path.isfile(self.fileName):
+            return
+        try:
+            with open(self.fileName, "rb") as f:
+                version, self.dirEntries, self.fileEntries = Unpickler(f).load()
+            if version != self.formatVersion:
+                self.dirEntries, self.fileEntries = {}, {}
+            self.diag.info("Loaded index of " + str(len(self.dirEntries)) + " directories from " + self.fileName)
+        except (IOError, EOFError, ValueError, TypeError, UnpicklingError):
+            self.diag.info("Could not read index file at " + self.fileName + ", ignoring it")
+            self.dirEntries, self.fileEntries = {}, {}
+
+    @staticmethod
+    def getStatKey(path):
+        statObj = os.stat(path)
+        return statObj.st_mtime, statObj.st_ino, statObj.st_size
+
+    def listdir(self, dir):
+        if dir in self.prefetched:
+            return list(self.prefetched.pop(dir))
+        self.readPaths.add(dir)
+        # stat before listing, so any change while we list causes a mismatch next time
+        statKey = self.getStatKey(dir)
+        cached = self.dirEntries.get(dir)
+        if cached is not None and cached[0] == statKey:
+            return list(cached[1])
+
+        self.diag.info("Listing changed directory " + dir)
+        contents = os.listdir(dir)
+        contents.sort()
+        self.dirEntries[dir] = statKey, contents
+        self.changed = True
+        return list(contents)
+
+    def readLines(self, fileName):
+        if fileName in self.prefetched:
+            return self.prefetched.pop(fileName)
+        self.readPaths.add(fileName)
+        statKey = self.getStatKey(fileName)
+        cached = self.fileEntries.get(fileName)
+        if cached is not None and cached[0] == statKey:
+            return cached[1]
+
+        self.diag.info("Reading changed file " + fileName)
+        lines = open(fileName).readlines()
+        self.fileEntries[fileName] = statKey, lines
+        self.changed = True
+        return lines
+
+    def prefetchTree(self, rootDir, appName, threadCount):
+        # Directory listing and test suite file reading are mostly waiting on the file system.
+        # Read a whole level of the tree at once, the tests themselves are still created in order afterwards
+        if rootDir in self.prefetchedRoots:
+            return
+        self.prefetchedRoots.add(rootDir)
+        dirs = [ rootDir ]
+        while len(dirs) > 0:
+            self.diag.info("Prefetching " + str(len(dirs)) + " directories with " + str(threadCount) + " threads")
+            subDirLists = self.mapInThreads(plugins.Callable(self.prefetchDir, appName), dirs, threadCount)
+            dirs = [ subDir for subDirs in subDirLists for subDir in subDirs ]
+        # The root suite already has its own directory cache
+        self.prefetched.pop(rootDir, None)
+
+    def forgetPrefetched(self, rootDir):
+        # Whatever wasn't used reading the tree (e.g. other versions' testsuite files, filtered tests)
+        # shouldn't be trusted by anything reading it later, such as the GUI
+        prefix = os.path.join(rootDir, "")
+        for path in self.prefetched.keys():
+            if path == rootDir or path.startswith(prefix):
+                del self.prefetched[path]
+        self.prefetchedRoots.discard(rootDir)
+
+    @staticmethod
+    def mapInThreads(method, items, threadCount):
+        # Not multiprocessing.pool.ThreadPool, which takes a tenth of a second to shut down
+        results = [ [] ] * len(items)
+        workQueue = Queue()
+        for i, item in enumerate(items):
+            workQueue.put((i, item))
+        def work():
+            while True:
+                try:
+                    i, item = workQueue.get_nowait()
+                except Empty:
+                    return
+                results[i] = method(item)
+        threads = [ Thread(target=work) for _ in range(min(threadCount, len(items))) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def prefetchDir(self, dir, appName):
+        try:
+            contents = self.listdir(dir)
+        except OSError:
+            return []
+        self.prefetched[dir] = contents
+        subDirs = []
+        for fileName in contents:
+            parts = fileName.split(".")
+            if parts[0] == "testsuite" and appName in parts[1:]:
+                path = os.path.join(dir, fileName)
+                try:
+                    lines = self.readLines(path)
+                except (IOError, OSError):
+                    continue
+                self.prefetched[path] = lines
+                items, _ = plugins.readListWithComments(path, lines=lines)
+                for testName in items:
+                    subDir = os.path.join(dir, testName)
+                    if not testName.startswith("#") and subDir not in subDirs:
+                        subDirs.append(subDir)
+        return subDirs
+
+    def addTrusted(self, dirEntries, fileEntries):
+        # Read by another process just now, so use them without checking, like prefetched ones
+        self.prefetched.update(dirEntries)
+        self.prefetched.update(fileEntries)
+
+    def getEntriesReadUnder(self, rootDir):
+        # Copy everything first, other applications' tests may be being read as we do this
+        prefix = os.path.join(rootDir, "")
+        paths = [ path for path in list(self.readPaths) if path == rootDir or path.startswith(prefix) ]
+        dirEntries, fileEntries = dict(self.dirEntries.items()), dict(self.fileEntries.items())
+        return dict(((path, dirEntries[path][1]) for path in paths if path in dirEntries)), \
+               dict(((path, fileEntries[path][1]) for path in paths if path in fileEntries))
+
+    def save(self):
+        if not self.changed or not self.fileName:
+            return
+        self.diag.info("Writing index of " + str(len(self.dirEntries)) + " directories to " + self.fileName)
+        try:
+            plugins.ensureDirExistsForFile(self.fileName)
+            tmpFile, tmpFileName = mkstemp(dir=os.path.dirname(self.fileName))
+            with os.fdopen(tmpFile, "wb") as f:
+                Pickler(f, 2).dump((self.formatVersion, self.dirEntries, self.fileEntries))
+            # Rename is atomic, so other runs never see a partially written index
+            shutil.move(tmpFileName, self.fileName)
+            self.changed = False
+        except (IOError, OSError), e:
+            plugins.printWarning("Could not write test tree index file at " + self.fileName + ": " + str(e))
+
+
+# What another TextTest process (e.g. a queue system master) found out about an application
+# and its test tree, so that processes it starts can create it without looking for and reading it all again
+class ApplicationSnapshot:
+    formatVersion = 1
+    def __init__(self, app):
+        self.name = app.name
+        self.versions = app.versions
+        self.dir = app.getDirectory()
+        self.config = app.configDir.items()
+        if app.testTreeIndex:
+            self.dirEntries, self.fileEntries = app.testTreeIndex.getEntriesReadUnder(self.dir)
+        else:
+            self.dirEntries, self.fileEntries = {}, {}
+
+    def write(self, fileName):
+        plugins.ensureDirExistsForFile(fileName)
+        with open(fileName, "wb") as f:
+            Pickler(f, 2).dump((self.formatVersion, self))
+
+    @classmethod
+    def read(cls, fileName):
+        try:
+            with open(fileName, "rb") as f:
+                version, snapshot = Unpickler(f).load()
+            if version == cls.formatVersion:
+                return snapshot
+        except (IOError, EOFError, ValueError, TypeError, AttributeError, UnpicklingError):
+            pass
+
+
+# Tracks which test directories have changed since the last refresh, so that refreshing
+# need only look at those. Polls the directories and every file in them,
+# unless pyinotify is available, in which case the kernel tells us instead.
+class TestTreeWatcher:
+    def __init__(self):
+        self.watchedDirs = {}
+        self.started = False
+        self.diag = logging.getLogger("test tree watcher")
+
+    def findChangedDirectories(self, suites):
+        # Returns None if we can't tell what changed, in which case everything should be refreshed
+        changedDirs = self.readChanges()
+        currentTests = OrderedDict()
+        for suite in suites:
+            for test in suite.allTestsAndSuites():
+                currentTests.setdefault(test.getDirectory(), test)
+        for dir in self.watchedDirs.keys():
+            if dir not in currentTests:
+                self.unwatch(dir)
+        for dir, test in currentTests.items():
+            if dir not in self.watchedDirs:
+                self.watch(dir, test)
+                # Not seen before, so it may have changed since it was created
+                if self.started and changedDirs is not None:
+                    changedDirs.add(dir)
+        self.started = True
+        self.diag.info("Changed directories " + repr(changedDirs))
+        return changedDirs
+
+    def getState(self, test):
+        # Files edited in place don't change the directory, so we need all of them, not just the listing
+        try:
+            return DirectoryIndex.getStatKey(test.getDirectory()), \
+                   [ DirectoryIndex.getStatKey(test.dircache.pathName(f)) for f in test.dircache.contents ]
+        except OSError:
+            return None
+
+    def watch(self, dir, test):
+        self.watchedDirs[dir] = test, self.getState(test)
+
+    def unwatch(self, dir):
+        del self.watchedDirs[dir]
+
+    def readChanges(self):
+        return self.pollChanges(self.watchedDirs)
+
+    def pollChanges(self, polledDirs):
+        changedDirs = set()
+        for dir, (test, state) in polledDirs.items():
+            newState = self.getState(test)
+            if newState != state:
+                changedDirs.add(dir)
+                polledDirs[dir] = test, newState
+        return changedDirs
+
+
+class InotifyTestTreeWatcher(TestTreeWatcher):
+    def __init__(self, pyinotify):
+        TestTreeWatcher.__init__(self)
+        self.pyinotify = pyinotify
+        self.mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_CLOSE_WRITE | \
+                    pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_ATTRIB
+        self.events = []
+        self.watchManager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watchManager, self.events.append, timeout=0)
+        # Directories the kernel wouldn't watch, usually because max_user_watches was reached
+        self.polledDirs = {}
+
+    def watch(self, dir, test):
+        descriptors = self.watchManager.add_watch(dir, self.mask)
+        descriptor = descriptors.get(dir, -1)
+        self.watchedDirs[dir] = descriptor
+        if descriptor < 0:
+            if not self.polledDirs:
+                plugins.printWarning("Could not watch the test directory " + dir + " for changes " +
+                                     "(maybe fs.inotify.max_user_watches is too low).\n" +
+                                     "Checking it, and any others that can't be watched, on each refresh instead.")
+            self.diag.info("Polling " + dir + ", could not watch it")
+            self.polledDirs[dir] = test, self.getState(test)
+
+    def unwatch(self, dir):
+        descriptor = self.watchedDirs.pop(dir)
+        self.polledDirs.pop(dir, None)
+        if descriptor >= 0:
+            self.watchManager.rm_watch(descriptor, quiet=True)
+
+    def readChanges(self):
+        while self.notifier.check_events(timeout=0):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        changedDirs = self.pollChanges(self.polledDirs)
+        for event in self.events:
+            if event.mask & self.pyinotify.IN_Q_OVERFLOW:
+                self.diag.info("Event queue overflowed, can't tell what changed")
+                changedDirs = None
+                break
+            changedDirs.add(event.path)
+        del self.events[:]
+        return changedDirs
+
+
+def makeTestTreeWatcher():
+    try:
+        import pyinotify
+        return InotifyTestTreeWatcher(pyinotify)
+    except (ImportError, AttributeError, OSError):
+        # Not installed, or not Linux
+        return TestTreeWatcher()
+
+
 class DynamicMapping:
     def __init__(self, method, *args):
         self.method = method
@@ -89,9 +449,17 @@ class DynamicMapping:
             raise KeyError, "No such value " + key
 
 
-class TestEnvironment(OrderedDict):
+# Tests only store the variables they set themselves, and look everything else up in the values of the suites
+# above them, which are shared and only copied if those suites need to change them later.
+# The values are only worked out when first asked for.
+class TestEnvironment(object):
     def __init__(self, populateFunction):
-        OrderedDict.__init__(self)
+        self.values = OrderedDict()
+        # Values set further up the test tree, most general first. Never written to from here.
+        self.parentLayers = ()
+        self.valuesShared = False
+        # What the values were created from, needed to create the environment of any subtests
+        self.envFiles, self.sourceVars, self.sourceProps = [], [], []
         self.diag = logging.getLogger("read environment")
         self.populateFunction = populateFunction
         self.populated = False
@@ -101,6 +469,65 @@ class TestEnvironment(OrderedDict):
             self.populated = True
             self.populateFunction()
 
+    def setSources(self, envFiles, sourceVars, sourceProps):
+        self.envFiles, self.sourceVars, self.sourceProps = envFiles, sourceVars, sourceProps
+
+    def layerOn(self, parentEnvironment):
+        self.diag.info("Layering values on parent environment")
+        self.parentLayers = tuple(layer for layer in parentEnvironment.getLayers() if layer)
+        parentEnvironment.valuesShared = True
+
+    def getLayers(self):
+        return self.parentLayers + (self.values,)
+
+    def sourcesReferToOther(self, vars):
+        # Would any value we were created from pick up a different variable set afterwards, once expanded?
+        for var, value in self.sourceVars:
+            if type(value) == types.StringType and "$" in value:
+                for otherVar, otherValue in vars:
+                    if otherVar != var and ("$" + otherVar in value or "${" + otherVar + "}" in value):
+                        return True
+        return False
+
+    def __setitem__(self, var, value):
+        if self.valuesShared:
+            # copy on write, so the tests layered on top of us don't see the change
+            self.values = OrderedDict(self.values.items())
+            self.valuesShared = False
+        self.values[var] = value
+
+    def __contains__(self, var):
+        return any(var in layer for layer in self.getLayers())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def has_key(self, var):
+        return var in self
+
+    def get(self, var, defaultValue=None):
+        for layer in reversed(self.getLayers()):
+            if var in layer:
+                return layer[var]
+        return defaultValue
+
+    def keys(self):
+        return [ var for var, _ in self.items() ]
+
+    def items(self):
+        if not self.parentLayers:
+            return self.values.items()
+        allValues = OrderedDict()
+        for layer in self.getLayers():
+            allValues.update(layer)
+        return allValues.items()
+
+    def iteritems(self):
+        return iter(self.items())
+
     def definesValue(self, var):
         self.checkPopulated()
         return self.has_key(var)
@@ -175,7 +602,7 @@ class TestEnvironment(OrderedDict):
 
     def expandVariables(self, expandExternal):
         expanded = False
-        for var, value in self.iteritems():
+        for var, value in self.items():
             if "$" in value:
                 self.diag.info("Expanding " + var + "...")
             mapping = DynamicMapping(self.getSingleValueNoSelfRef, var, expandExternal)
@@ -189,13 +616,15 @@ class TestEnvironment(OrderedDict):
 
 # Base class for TestCase and TestSuite
 class Test(plugins.Observable):
+    # Shared by all tests without properties of their own, never written to
+    noProperties = plugins.MultiEntryDictionary()
     def __init__(self, name, description, dircache, app, parent=None):
         # Should notify which test it is
         plugins.Observable.__init__(self, passSelf=True)
-        self.name = name
+        self.name = intern(name) if type(name) is str else name
         self.description = description
         # There is nothing to stop several tests having the same name. Maintain another name known to be unique
-        self.uniqueName = name
+        self.uniqueName = self.name
         self.app = app
         self.parent = parent
         self.dircache = dircache
@@ -205,7 +634,7 @@ class Test(plugins.Observable):
         populateFunction = plugins.Callable(app.setEnvironment, self)
         self.environment = TestEnvironment(populateFunction)
         # Java equivalent of the environment mechanism...
-        self.properties = plugins.MultiEntryDictionary()
+        self.properties = self.noProperties
         # Test suites never change state, but it's convenient that they have one
         self.state = plugins.TestState("not_started")
         self.writeDirectory = os.path.join(app.writeDirectory, self.getWriteDirRelPath())
@@ -259,7 +688,7 @@ class Test(plugins.Observable):
         return self.name.ljust(maxLength)
 
     def changeDirectory(self, newDir, origRelPath):
-        self.dircache = DirectoryCache(newDir)
+        self.dircache = DirectoryCache(newDir, self.app.testTreeIndex)
         self.notify("NameChange", origRelPath)
 
     def setName(self, newName):
@@ -290,7 +719,12 @@ class Test(plugins.Observable):
     def setEnvironment(self, var, value):
         self.environment[var] = value
 
+    def shareProperties(self, test):
+        self.properties = test.properties
+
     def addProperty(self, var, value, propFile):
+        if self.properties is self.noProperties or (self.parent and self.properties is self.parent.properties):
+            self.properties = plugins.MultiEntryDictionary()
         if not self.properties.has_key(propFile):
             self.properties.addEntry(propFile, {})
         self.properties.addEntry(var, value, sectionName = propFile)
@@ -659,6 +1093,12 @@ class Test(plugins.Observable):
         self.refreshFiles()
         self.notify("FileChange")
 
+    def refreshChanged(self, filters, changedDirs):
+        if self.getDirectory() in changedDirs:
+            self.refreshFiles()
+            self.reloadConfiguration()
+            self.notify("FileChange")
+
     def findCommonAncestor(self, other):
         if self.hasAncestor(other):
             self.diagnose("Have ancestor " + other.uniqueName)
@@ -712,8 +1152,11 @@ class TestCase(Test):
     def __init__(self, name, description, abspath, app, parent):
         Test.__init__(self, name, description, abspath, app, parent)
         # Directory where test executes from and hopefully where all its files end up
-        relPath = self.getWriteDirRelPath()
-        self.localWriteDirectory = os.path.join(app.localWriteDirectory, relPath)
+        if app.localWriteDirectory == app.writeDirectory:
+            self.localWriteDirectory = self.writeDirectory
+        else:
+            relPath = self.getWriteDirRelPath()
+            self.localWriteDirectory = os.path.join(app.localWriteDirectory, relPath)
 
     def classId(self):
         return "test-case"
@@ -984,22 +1427,102 @@ class TestCase(Test):
 
 
 # class for caching and managing changes to test suite files
+# The entries of a testsuite file, in order. Comments are entries too (keyed on their text, starting with "#"),
+# so they stay where they are relative to the tests around them when tests are added, moved and removed.
+class TestSuiteFileContents:
+    def __init__(self, items=[]):
+        self.names = [ name for name, _ in items ]
+        self.descriptions = dict(items)
+        self.testPositions = None # positions in self.names of the tests, i.e. not the comments. Worked out when needed
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.descriptions
+
+    def has_key(self, name):
+        return name in self.descriptions
+
+    def __getitem__(self, name):
+        return self.descriptions[name]
+
+    def get(self, name, default=None):
+        return self.descriptions.get(name, default)
+
+    def keys(self):
+        return list(self.names)
+
+    def items(self):
+        return [ (name, self.descriptions[name]) for name in self.names ]
+
+    def insert(self, position, name, description):
+        if name in self.descriptions:
+            self.remove(name)
+        self.names.insert(position, name)
+        self.descriptions[name] = description
+        self.testPositions = None
+
+    def remove(self, name):
+        description = self.descriptions.pop(name, None)
+        if description is None:
+            return None, None
+        index = self.names.index(name)
+        del self.names[index]
+        self.testPositions = None
+        return description, index
+
+    def getInsertPosition(self, position):
+        # Position counts tests only: insert after the test currently at that position
+        if position >= 1:
+            if self.testPositions is None:
+                self.testPositions = [ i for i, name in enumerate(self.names) if not name.startswith("#") ]
+            if position <= len(self.testPositions):
+                return self.testPositions[position - 1] + 1
+            else:
+                return len(self.names)
+        return position
+
+
 class TestSuiteFileHandler:
     def __init__(self):
         self.cache = {}
-
-    def readWithWarnings(self, fileName, ignoreCache=False, filterMethod=None):
-        items, badTests = self.readFromFileOrCache(fileName, ignoreCache, filterMethod)
+        self.batchFileNames = None
+
+    def startBatch(self):
+        # Until flushBatch is called, edits only change the cache. Each file is then written once
+        self.batchFileNames = []
+
+    def flushBatch(self):
+        # Returns the files that couldn't be written, with the reason. What we had cached for them
+        # was never written, so it's dropped, and they'll be read again as they are
+        fileNames, self.batchFileNames = self.batchFileNames, None
+        failures = OrderedDict()
+        for fileName in fileNames:
+            try:
+                self.write(fileName, self.cache[fileName])
+            except EnvironmentError, e:
+                failures[fileName] = str(e)
+                self.cache.pop(fileName, None)
+        return failures
+
+    def readWithWarnings(self, fileName, ignoreCache=False, filterMethod=None, index=None):
+        items, badTests = self.readFromFileOrCache(fileName, ignoreCache, filterMethod, index)
         goodTests = self.getTestWithDescriptions(items)
         self.cache[fileName] = items
         return goodTests, badTests
 
-    def readFromFileOrCache(self, fileName, ignoreCache=False, filterMethod=None):
+    def readFromFileOrCache(self, fileName, ignoreCache=False, filterMethod=None, index=None):
         if not ignoreCache:
             cached = self.cache.get(fileName)
             if cached is not None:
                 return cached, OrderedDict()
-        return plugins.readListWithComments(fileName, plugins.Callable(self.getExclusionReasons, filterMethod))
+        lines = index.readLines(fileName) if index else None
+        items, badTests = plugins.readListWithComments(fileName, plugins.Callable(self.getExclusionReasons, filterMethod), lines)
+        return TestSuiteFileContents(items.items()), badTests
 
     def getTestWithDescriptions(self, tests):
         onlyTest = OrderedDict()
@@ -1027,12 +1550,32 @@ class TestSuiteFileHandler:
         return "", ""
 
     def write(self, fileName, content):
+        if self.batchFileNames is not None:
+            if fileName not in self.batchFileNames:
+                self.batchFileNames.append(fileName)
+            return
         testEntries = self.makeWriteEntries(content)
         output = "\n".join(testEntries)
         if not output.endswith("\n"):
             output += "\n"
+        self.writeFile(fileName, output.lstrip())
+
+    def writeFile(self, fileName, output):
+        # Write a new file and move it into place, so nobody ever reads a half-written one.
+        # Links are written through, and we can still edit files in directories we can't create files in
+        if os.path.isfile(fileName) and not os.path.islink(fileName):
+            try:
+                tmpFile, tmpFileName = mkstemp(dir=os.path.dirname(fileName), prefix=os.path.basename(fileName))
+            except OSError:
+                pass
+            else:
+                with os.fdopen(tmpFile, "w") as f:
+                    f.write(output)
+                shutil.copymode(fileName, tmpFileName)
+                shutil.move(tmpFileName, fileName)
+                return
         newFile = plugins.openForWrite(fileName)
-        newFile.write(output.lstrip())
+        newFile.write(output)
         newFile.close()
 
     def makeWriteEntries(self, content):
@@ -1056,25 +1599,10 @@ class TestSuiteFileHandler:
         self.addToCache(fileName, cache, *args)
 
     def addToCache(self, fileName, cache, testName, description, index, mapIndex=True):
-        cacheList = cache.items()
-        position = self.getInsertPosition(cache, index) if mapIndex else index
-        cacheList.insert(position, (testName, description))
-        newCache = OrderedDict(cacheList)
-        self.cache[fileName] = newCache
-        self.write(fileName, newCache)
-
-    def getInsertPosition(self, cache, position):
-        testList = self.getTestWithDescriptions(cache).items()
-        cacheList = cache.items()
-        if position >= 1:
-            if position <= len(testList):
-                try:
-                    return cacheList.index(testList[position -1]) + 1
-                except:
-                    pass
-            else:
-                return len(cacheList)
-        return position
+        position = cache.getInsertPosition(index) if mapIndex else index
+        cache.insert(position, testName, description)
+        self.cache[fileName] = cache
+        self.write(fileName, cache)
 
     def remove(self, fileName, testName):
         cache = self.readWithComments(fileName)
@@ -1083,13 +1611,7 @@ class TestSuiteFileHandler:
             self.write(fileName, cache)
 
     def removeFromCache(self, cache, testName):
-        description = cache.get(testName)
-        if description is not None:
-            index = cache.keys().index(testName)
-            del cache[testName]
-            return description, index
-        else:
-            return None, None
+        return cache.remove(testName)
 
     def rename(self, fileName, oldName, newName, newDescription):
         cache = self.readWithComments(fileName)
@@ -1114,9 +1636,9 @@ class TestSuiteFileHandler:
         newList = [(testName,tests[testName]) for testName in sorted(tests.keys(), comparator)]
         for index, key, comment in comments:
             newList.insert(index, (key, comment))
-        newDict = OrderedDict(newList)
-        self.cache[fileName] = newDict
-        self.write(fileName, newDict)
+        newContents = TestSuiteFileContents(newList)
+        self.cache[fileName] = newContents
+        self.write(fileName, newContents)
 
     def getCommentsWithPositions(self, fileName):
         cache = self.readWithComments(fileName).items()
@@ -1133,6 +1655,16 @@ class TestSuite(Test):
         self.autoSortOrder = self.getConfigValue("auto_sort_test_suites")
 
     def readContents(self, filters=[], initial=True, guideSuite=None):
+        if self.parent is None and guideSuite is None:
+            self.app.prefetchTestTree(self.getDirectory())
+            try:
+                return self.readContentsAndCheck(filters, initial, guideSuite)
+            finally:
+                self.app.forgetPrefetchedTestTree(self.getDirectory())
+        else:
+            return self.readContentsAndCheck(filters, initial, guideSuite)
+
+    def readContentsAndCheck(self, filters, initial, guideSuite):
         testNames, badTestNames = self.readTestNamesWithWarnings(guideSuite=guideSuite)
         self.createTestCases(filters, testNames, initial, guideSuite)
         if self.isEmpty() and len(testNames) > 0:
@@ -1161,7 +1693,7 @@ class TestSuite(Test):
             return testNames, OrderedDict()
         fileName = self.getContentFileName()
         if fileName:
-            return self.testSuiteFileHandler.readWithWarnings(fileName, ignoreCache, self.fileExists)
+            return self.testSuiteFileHandler.readWithWarnings(fileName, ignoreCache, self.fileExists, self.app.testTreeIndex)
         else:
             return OrderedDict(), OrderedDict()
 
@@ -1264,6 +1796,25 @@ class TestSuite(Test):
     def refresh(self, filters):
         self.diagnose("refreshing!")
         Test.refresh(self, filters)
+        self.refreshTestList(filters, lambda test: test.refresh(filters))
+
+    def refreshChanged(self, filters, changedDirs):
+        dir = self.getDirectory()
+        if dir in changedDirs:
+            self.diagnose("refreshing changed suite")
+            self.refreshFiles()
+            oldConfigDir = self.configDir
+            self.reloadConfiguration()
+            if self.configDir != oldConfigDir:
+                for test in self.testcases:
+                    test.reloadTestConfigurations()
+            self.notify("FileChange")
+            self.refreshTestList(filters, lambda test: test.refreshChanged(filters, changedDirs))
+        elif any(changedDir.startswith(os.path.join(dir, "")) for changedDir in changedDirs):
+            for test in self.testcases:
+                test.refreshChanged(filters, changedDirs)
+
+    def refreshTestList(self, filters, refreshMethod):
         newTestNames = self.readTestNames(ignoreCache=True)
         toRemove = filter(lambda test: test.name not in newTestNames, self.testcases)
         for test in toRemove:
@@ -1274,7 +1825,7 @@ class TestSuite(Test):
             existingTest = self.findSubtest(testName)
             if existingTest:
                 existingTest.setDescription(descStr)
-                existingTest.refresh(filters)
+                refreshMethod(existingTest)
                 testClass = self.getSubtestClass(existingTest.dircache)
                 if existingTest.__class__ != testClass:
                     self.diagnose("changing type for " + repr(existingTest))
@@ -1332,7 +1883,7 @@ class TestSuite(Test):
                 subTest.notify("Add", initial)
 
     def createTestCache(self, testName):
-        return DirectoryCache(os.path.join(self.getDirectory(), testName))
+        return DirectoryCache(os.path.join(self.getDirectory(), testName), self.app.testTreeIndex)
 
     def getSubtestClass(self, cache):
         return TestSuite if cache.hasStem("testsuite." + self.app.name) else TestCase
@@ -1497,7 +2048,7 @@ class ConfigurationCall:
         raise BadConfigError, message
 
 class Application(object):
-    def __init__(self, name, dircache, versions, inputOptions, configEntries={}):
+    def __init__(self, name, dircache, versions, inputOptions, configEntries={}, snapshot=None):
         self.name = name
         self.dircache = dircache
         # Place to store reference to extra_version applications
@@ -1509,8 +2060,9 @@ class Application(object):
         self.inputOptions = inputOptions
         self.configDir = plugins.MultiEntryDictionary(importKey="import_config_file", importFileFinder=self.configPath)
         self.overrideConfigDir = {}
-        self.setUpConfiguration(configEntries)
+        self.setUpConfiguration(configEntries, snapshot)
         self.checkSanity()
+        self.testTreeIndex = self.makeTestTreeIndex(snapshot)
         self.writeDirectory, self.localWriteDirectory = self.getWriteDirectories()
         self.rootTmpDir = os.path.dirname(self.writeDirectory)
         self.diag.info("Write directory at " + self.writeDirectory)
@@ -1543,12 +2095,29 @@ class Application(object):
             dircache = DirectoryCache(plugins.getPersonalConfigDir())
             return self.getAllFileNames([ dircache ], "config")
 
-    def setUpConfiguration(self, configEntries={}):
+    def setUpConfiguration(self, configEntries={}, snapshot=None):
         self.configDir.clear()
         self.configDocs = {}
         self.defaultDirCaches = self.getDefaultDirCaches()
         self.extraDirCaches = {}
         self.setConfigDefaults()
+        if snapshot is not None:
+            self.setUpConfigurationFromSnapshot(snapshot)
+        else:
+            self.readConfiguration(configEntries)
+        if not plugins.TestState.showExecHosts:
+            plugins.TestState.showExecHosts = self.configObject.showExecHostsInFailures(self)
+
+    def setUpConfigurationFromSnapshot(self, snapshot):
+        # The settings are already resolved, but the config module still needs to register its defaults,
+        # which it does by setting them. So apply them both before and after.
+        self.configDir.update(snapshot.config)
+        self.configObject = self.makeConfigObject()
+        self.configObject.setApplicationDefaults(self)
+        self.configDir.update(snapshot.config)
+        self.diag.info("Config file settings from snapshot are: " + "\n" + repr(self.configDir))
+
+    def readConfiguration(self, configEntries):
 
         # Read our pre-existing config files
         self.readConfigFiles(configModuleInitialised=False)
@@ -1571,8 +2140,6 @@ class Application(object):
         self.configDir.readValues(self.getPersonalConfigFiles(), insert=False, errorOnUnknown=False)
         self.setInterpreters()
         self.diag.info("Config file settings are: " + "\n" + repr(self.configDir))
-        if not plugins.TestState.showExecHosts:
-            plugins.TestState.showExecHosts = self.configObject.showExecHostsInFailures(self)
 
     def reloadConfiguration(self):
         # Try to make this as atomic as possible, to avoid problems when other threads
@@ -1596,6 +2163,32 @@ class Application(object):
     def getConfigFileDefining(self, *args):
         return self.configDir.getFileDefining(*args)
 
+    def makeTestTreeIndex(self, snapshot=None):
+        if snapshot is not None:
+            index = DirectoryIndex.getInstance(None)
+            index.addTrusted(snapshot.dirEntries, snapshot.fileEntries)
+            return index
+        indexFile = self.getConfigValue("test_tree_index_file")
+        if indexFile:
+            if not os.path.isabs(indexFile):
+                indexFile = os.path.join(self.getDirectory(), indexFile)
+            return DirectoryIndex.getInstance(os.path.normpath(indexFile))
+        elif self.getConfigValue("test_tree_read_threads") > 0 or self.configObject.recordsTestTree(self):
+            return DirectoryIndex.getInstance(None)
+
+    def prefetchTestTree(self, rootDir):
+        threadCount = self.getConfigValue("test_tree_read_threads")
+        if self.testTreeIndex and threadCount > 0:
+            self.testTreeIndex.prefetchTree(rootDir, self.name, threadCount)
+
+    def forgetPrefetchedTestTree(self, rootDir):
+        if self.testTreeIndex:
+            self.testTreeIndex.forgetPrefetched(rootDir)
+
+    def saveTestTreeIndex(self):
+        if self.testTreeIndex:
+            self.testTreeIndex.save()
+
     def writeConfigEntries(self, configEntries):
         configFileName = self.dircache.pathName("config." + self.name)
         configFile = open(configFileName, "w")
@@ -1734,13 +2327,34 @@ class Application(object):
     def setEnvironment(self, test):
         test.environment.diag.info("Reading environment for " + repr(test))
         envFiles = test.getAllPathNames("environment")
-        allVars = sum((self.readEnvironment(f) for f in envFiles), [])
-        allProps = []
-        for suite in test.getAllTestsToRoot():
-            vars, props = self.configObject.getConfigEnvironment(suite, allVars)
+        parentEnvironment = test.parent.environment if test.parent else None
+        if parentEnvironment is not None:
+            parentEnvironment.checkPopulated()
+        if parentEnvironment is not None and envFiles == parentEnvironment.envFiles:
+            # Same files as the parent, so everything it was created from applies here too
+            allVars = list(parentEnvironment.sourceVars)
+            allProps = list(parentEnvironment.sourceProps)
+            vars, props = self.configObject.getConfigEnvironment(test, allVars)
+            if len(props) == 0 and not parentEnvironment.sourcesReferToOther(vars):
+                # Only store what this test sets itself (at least the sandbox variables for test cases)
+                test.environment.layerOn(parentEnvironment)
+                test.shareProperties(test.parent)
+                if test.classId() == "test-suite":
+                    test.environment.setSources(envFiles, allVars + vars, allProps)
+                test.environment.storeVariables(vars, self.configObject.expandExternalEnvironment())
+                return
             allVars += vars
             allProps += props
-
+        else:
+            allVars = sum((self.readEnvironment(f) for f in envFiles), [])
+            allProps = []
+            for suite in test.getAllTestsToRoot():
+                vars, props = self.configObject.getConfigEnvironment(suite, allVars)
+                allVars += vars
+                allProps += props
+
+        if test.classId() == "test-suite":
+            test.environment.setSources(envFiles, allVars, allProps)
         test.environment.storeVariables(allVars, self.configObject.expandExternalEnvironment())
         for var, value, propFile in allProps:
             test.addProperty(var, value, propFile)
@@ -1888,6 +2502,8 @@ class Application(object):
         self.setConfigDefault("version_priority", { "default": 99 }, \
                               "Mapping of version names to a priority order in case of conflict.")
         self.setConfigDefault("extra_search_directory", { "default" : [] }, "Additional directories to search for TextTest files")
+        self.setConfigDefault("test_tree_index_file", "", "File to store an index of the test tree in, so unchanged directories need not be re-read")
+        self.setConfigDefault("test_tree_read_threads", 0, "Number of threads to use for reading the test tree from disk. 0 means read it sequentially")
         self.setConfigDefault("filename_convention_scheme", "classic", "Naming scheme to use for files for stdin,stdout and stderr")
         self.setConfigAlias("test_data_searchpath", "extra_search_directory")
         self.setConfigAlias("extra_config_directory", "extra_search_directory")